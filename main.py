@@ -1,4 +1,5 @@
 import os
+import warnings
 from pathlib import Path
 
 import hydra
@@ -50,6 +51,7 @@ def init_env(config: DictConfig) -> EternityEnv:
         env.batch_size,
         config.device,
         config.seed,
+        config.compile,
     )
 
 
@@ -70,6 +72,7 @@ def init_models(config: DictConfig) -> tuple[Policy, Critic]:
         decoder_layers=model.decoder_layers,
         dropout=model.dropout,
     )
+
     return policy, critic
 
 
@@ -107,8 +110,13 @@ def init_optimizer(config: DictConfig, model: nn.Module) -> optim.Optimizer:
         "lion": Lion,
     }
 
+    kwargs = dict()
+    if optimizer_name in {"adamw", "adam"}:
+        # A single kernel for the whole step, only available on GPU.
+        kwargs["fused"] = torch.device(config.device).type == "cuda"
+
     return optimizers[optimizer_name](
-        model.parameters(), lr=lr, weight_decay=weight_decay
+        model.parameters(), lr=lr, weight_decay=weight_decay, **kwargs
     )
 
 
@@ -152,11 +160,12 @@ def init_scheduler(
 def init_replay_buffer(config: DictConfig) -> ReplayBuffer:
     exp = config.exp
     max_size = exp.env.batch_size * exp.trainer.rollouts
+    # The samples are stored on the training device, there is nothing to pin.
     return TensorDictReplayBuffer(
         storage=LazyTensorStorage(max_size=max_size, device=config.device),
         sampler=SamplerWithoutReplacement(drop_last=True),
         batch_size=exp.trainer.batch_size,
-        pin_memory=True,
+        pin_memory=False,
     )
 
 
@@ -189,6 +198,8 @@ def init_trainer(
         trainer.epochs,
         trainer.rollouts,
         trainer.reset_proportion,
+        trainer.accumulation_steps,
+        config.compile,
     )
 
 
@@ -200,10 +211,30 @@ def reload_checkpoint(config: DictConfig, trainer: Trainer):
     checkpoint_path = config.exp.checkpoint
     state_dict = torch.load(checkpoint_path, map_location=config.device)
 
+    # The sides embeddings have been removed from the policy. They are dropped from
+    # older checkpoints, whatever the prefix of the wrapped models ("module.", ...).
+    stale_keys = [
+        key for key in state_dict["policy"] if key.split(".")[-1] == "sides_embeddings"
+    ]
+    for key in stale_keys:
+        del state_dict["policy"][key]
+    if len(stale_keys) > 0:
+        warnings.warn(
+            f"Older policy checkpoint, the stale keys {stale_keys} are dropped. "
+            "The second side is no longer conditioned on the first one."
+        )
+
     trainer.policy.load_state_dict(state_dict["policy"])
     trainer.critic.load_state_dict(state_dict["critic"])
 
-    trainer.policy_optimizer.load_state_dict(state_dict["policy-optimizer"])
+    # The optimizer state of an older policy no longer matches its parameters.
+    if len(stale_keys) == 0:
+        trainer.policy_optimizer.load_state_dict(state_dict["policy-optimizer"])
+    else:
+        warnings.warn(
+            "Older policy checkpoint, its optimizer state is not loaded. "
+            "The policy optimizer starts from scratch."
+        )
     trainer.critic_optimizer.load_state_dict(state_dict["critic-optimizer"])
 
     trainer.policy_scheduler.load_state_dict(state_dict["policy-scheduler"])
@@ -227,8 +258,19 @@ def run_trainer_ddp(rank: int, world_size: int, config: DictConfig):
     env = init_env(config)
     policy, critic = init_models(config)
     policy, critic = policy.to(config.device), critic.to(config.device)
-    policy = DDP(policy, device_ids=[config.device], output_device=config.device)
-    critic = DDP(critic, device_ids=[config.device], output_device=config.device)
+    # The gradients are views of the DDP buckets, this avoids copying them.
+    policy = DDP(
+        policy,
+        device_ids=[config.device],
+        output_device=config.device,
+        gradient_as_bucket_view=True,
+    )
+    critic = DDP(
+        critic,
+        device_ids=[config.device],
+        output_device=config.device,
+        gradient_as_bucket_view=True,
+    )
     loss = init_loss(config)
     policy_optimizer = init_optimizer(config, policy)
     critic_optimizer = init_optimizer(config, critic)
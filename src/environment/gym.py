@@ -1,8 +1,9 @@
 """A batched version of the environment.
 All actions are made on the batch.
 """
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 
 import gymnasium as gym
 import gymnasium.spaces as spaces
@@ -25,27 +26,6 @@ from .constants import (
 )
 from .draw import draw_gif, draw_instance
 
-# Defines convs that will compute vertical and horizontal matches.
-# Shapes are [out_channels, in_channels, kernel_height, kernel_width].
-# See `EternityEnv.matches` for more information.
-# Don't forget that the y-axis is reversed!!
-HORIZONTAL_CONV = torch.zeros((1, N_SIDES, 2, 1))
-HORIZONTAL_CONV[0, SOUTH, 1, 0] = 1
-HORIZONTAL_CONV[0, NORTH, 0, 0] = -1
-
-VERTICAL_CONV = torch.zeros((1, N_SIDES, 1, 2))
-VERTICAL_CONV[0, EAST, 0, 0] = 1
-VERTICAL_CONV[0, WEST, 0, 1] = -1
-
-# Convs to detect the 0-0 matches.
-HORIZONTAL_ZERO_CONV = torch.zeros((1, N_SIDES, 2, 1))
-HORIZONTAL_ZERO_CONV[0, SOUTH, 1, 0] = 1
-HORIZONTAL_ZERO_CONV[0, NORTH, 0, 0] = 1
-
-VERTICAL_ZERO_CONV = torch.zeros((1, N_SIDES, 1, 2))
-VERTICAL_ZERO_CONV[0, EAST, 0, 0] = 1
-VERTICAL_ZERO_CONV[0, WEST, 0, 1] = 1
-
 
 class EternityEnv(gym.Env):
     """A batched version of the environment.
@@ -62,6 +42,8 @@ class EternityEnv(gym.Env):
         device: str = "cpu",
         seed: int = 0,
         sample_size: int = 40,
+        compile: bool = False,
+        n_classes: int | None = None,
     ):
         """Initialize the environment.
 
@@ -74,6 +56,9 @@ class EternityEnv(gym.Env):
             device: The device to use.
             seed: The seed for the random number generator.
             sample_size: The number of steps to sample for the GIF.
+            compile: Whether to compile the per-step tensor operations.
+            n_classes: The number of classes of the instances. If not given, it is
+                read from the instances, which syncs with their device.
         """
         assert len(instances.shape) == 4, "Tensor must have 4 dimensions."
         assert instances.shape[1] == N_SIDES, "The pieces must have 4 sides."
@@ -81,31 +66,72 @@ class EternityEnv(gym.Env):
         assert torch.all(instances >= 0), "Classes must be positives."
         assert sample_size > 0, "Provide a positive number of frames for the gif."
 
+        if n_classes is None:
+            n_classes = int(instances.max().cpu().item() + 1)
+        assert n_classes <= 256, "Classes must fit in an uint8."
+
         super().__init__()
-        self.instances = instances.to(device)
         self.episode_length = episode_length
         self.device = device
         self.rng = torch.Generator(device).manual_seed(seed)
 
+        # The tiles are stored as [batch_size, n_pieces, N_SIDES] so that the sides
+        # of a tile are contiguous in memory. The env owns its own copy, as the
+        # tiles are modified in-place.
+        tiles = rearrange(instances, "b s h w -> b (h w) s")
+        tiles = tiles.to(torch.uint8, memory_format=torch.contiguous_format)
+        if tiles.device.type == "cpu" and torch.device(device).type == "cuda":
+            # Asynchronous upload, later operations on the device are queued after it.
+            tiles = tiles.pin_memory()
+        self.tiles = tiles.to(device, non_blocking=True)
+
         # Instances infos.
-        self.board_size = self.instances.shape[-1]
+        self.board_size = instances.shape[-1]
         self.n_pieces = self.board_size * self.board_size
-        self.n_classes = int(self.instances.max().cpu().item() + 1)
+        self.n_classes = n_classes
         self.best_possible_matches = 2 * self.board_size * (self.board_size - 1)
-        self.batch_size = self.instances.shape[0]
+        self.batch_size = instances.shape[0]
+
+        # Constant tensors, built once instead of at every step.
+        self.batch_range = torch.arange(self.batch_size, device=device)
+        self.sides_range = torch.arange(N_SIDES, device=device)
+        self.neighbour_offsets = torch.tensor(
+            [self.board_size, 1, -self.board_size, -1], device=device
+        )  # Tile id offsets of the neighbours, indexed by sides.
+        self.facing_sides = (self.sides_range + 2) % N_SIDES
+        # Sides permutations of a tile rolled by each possible shift.
+        self.roll_permutations = (
+            self.sides_range.unsqueeze(0) - self.sides_range.unsqueeze(1)
+        ) % N_SIDES
+
+        # The steps can be queued on their own stream, to overlap with the model
+        # kernels that do not depend on them.
+        self.stream = (
+            torch.cuda.Stream(device) if torch.device(device).type == "cuda" else None
+        )
+
+        # All shapes are static, so the step operations are compiled once and fused.
+        # The default mode is used since the tiles are modified in-place.
+        self.compile = compile
+        if compile:
+            self.play_action = torch.compile(self.play_action, dynamic=False)
+            self.replay_action = torch.compile(self.replay_action, dynamic=False)
 
         # Dynamic infos.
+        # The current matches are kept in a buffer updated at each step,
+        # so that the boards are counted only once per step.
+        self.n_matches = self.matches
         self.best_matches = torch.zeros(
             self.batch_size, dtype=torch.long, device=device
         )
-        self.best_boards = self.instances.clone()
+        self.best_boards = self.instances
         self.rolling_matches = torch.zeros(1, dtype=torch.float, device=device)
         self.n_steps = torch.zeros(self.batch_size, dtype=torch.long, device=device)
         self.best_board_ever = torch.zeros(
             (N_SIDES, self.board_size, self.board_size), dtype=torch.long
         )
         self.best_matches_ever = 0
-        self.total_won = 0
+        self.total_won = torch.zeros(1, dtype=torch.long, device=device)
         self.current_sample_step = 0
         self.sample_size = sample_size
         self.game_sample = torch.zeros(
@@ -126,7 +152,7 @@ class EternityEnv(gym.Env):
             ]
         )
         self.observation_space = spaces.Box(
-            low=0, high=1, shape=self.instances.shape[1:], dtype=np.uint8
+            low=0, high=1, shape=self.best_boards.shape[1:], dtype=np.uint8
         )
 
     def reset(
@@ -138,14 +164,15 @@ class EternityEnv(gym.Env):
         Scrambles the instances and reset their infos.
         """
         if instance_ids is None:
-            instance_ids = torch.arange(
-                start=0, end=self.batch_size, device=self.device
-            )
+            instance_ids = self.batch_range
 
         self.scramble_instances(instance_ids)
 
-        self.best_matches[instance_ids] = self.matches[instance_ids]
-        self.best_boards[instance_ids] = self.instances[instance_ids].clone()
+        self.n_matches.copy_(self.matches)
+        self.best_matches[instance_ids] = self.n_matches[instance_ids]
+        self.best_boards[instance_ids] = self.boards_view(
+            self.tiles[instance_ids]
+        ).long()
         self.n_steps[instance_ids] = 0
         just_won = torch.zeros(self.batch_size, dtype=torch.bool, device=self.device)
 
@@ -164,7 +191,7 @@ class EternityEnv(gym.Env):
 
     @torch.no_grad()
     def step(
-        self, actions: torch.Tensor
+        self, actions: torch.Tensor, actions_ready: torch.cuda.Event | None = None
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, bool, dict[str, Any]]:
         """Do a batched step through all instances.
 
@@ -173,13 +200,17 @@ class EternityEnv(gym.Env):
             actions: Batch of actions to apply.
                 Long tensor of shape of [batch_size, actions]
                 where actions are a tuple (tile_id_1, tile_id_2, shift_1, shift_2).
+            actions_ready: Event marking when the actions are computed, given by
+                `record_event`. The step then runs on the env stream and only
+                waits for this event, so it overlaps with the caller kernels
+                queued after it. The outputs can be used right away.
 
         ---
         Returns:
             observations: The observation of the environments.
                 Shape of [batch_size, N_SIDES, size, size].
-            rewards: The reward of the environments.
-                Shape of [batch_size,].
+            rewards: The number of matches gained by the environments.
+                Long tensor of shape [batch_size,].
             dones: Whether the environments are terminated (won or end of episode).
                 Shape of [batch_size,].
             truncated: Whether the environments are truncated (max steps reached).
@@ -190,130 +221,301 @@ class EternityEnv(gym.Env):
                 - `best-boards`: Best boards seen since the beggining of the games.
                 - `best-matches`: Best scores since the beggining of the games.
         """
-        tiles_id_1, tiles_id_2 = actions[:, 0], actions[:, 1]
-        shifts_1, shifts_2 = actions[:, 2], actions[:, 3]
+        with self.on_env_stream(actions_ready):
+            matches, rewards, just_won, dones = self.play_action(actions)
+            truncated = torch.zeros(
+                self.batch_size, dtype=torch.bool, device=self.device
+            )
 
-        previous_matches = self.matches.clone()
-        self.n_steps += 1
+            # Internal metrics.
+            improved = matches > self.best_matches
+            self.best_boards[improved] = self.boards_view(self.tiles[improved]).long()
+            self.best_matches[improved] = matches[improved]
 
-        self.roll_tiles(tiles_id_1, shifts_1)
-        self.roll_tiles(tiles_id_2, shifts_2)
-        self.swap_tiles(tiles_id_1, tiles_id_2)
+            self.rolling_matches = (
+                0.99 * self.rolling_matches + 0.01 * matches.float().mean()
+            )
+            self.total_won += just_won.sum()  # Stays on device, no sync.
 
-        matches = self.matches
+            self.update_best_env()
+            boards = self.boards_view(self.tiles)
+            self.game_sample[self.current_sample_step] = boards[0].cpu()
+            self.current_sample_step = (self.current_sample_step + 1) % self.sample_size
 
-        truncated = torch.zeros(self.batch_size, dtype=torch.bool, device=self.device)
-        just_won = matches == self.best_possible_matches
-        dones = just_won | (self.n_steps >= self.episode_length)
+            infos = {
+                "just-won": just_won,
+                "n-steps": self.n_steps,
+                "best-boards": self.best_boards,
+                "best-matches": self.best_matches,
+            }
 
-        # Internal metrics.
-        diff_matches = matches - self.best_matches
-        self.best_boards[diff_matches > 0] = self.instances[diff_matches > 0].clone()
-        self.best_matches[diff_matches > 0] = matches[diff_matches > 0]
+            observations = self.render()
 
-        self.rolling_matches = (
-            0.99 * self.rolling_matches + 0.01 * matches.float().mean()
-        )
-        self.total_won += just_won.sum().cpu().item()
+        return observations, rewards, dones, truncated, infos
+
+    def record_event(self) -> torch.cuda.Event | None:
+        """Mark the work queued so far by the caller, on GPU only.
+        A step given this event does not wait for the work queued afterwards.
+        """
+        if self.stream is None:
+            return None
+
+        return torch.cuda.current_stream(self.device).record_event()
+
+    @contextmanager
+    def on_env_stream(self, inputs_ready: torch.cuda.Event | None) -> Iterator[None]:
+        """Run the enclosed operations on the env stream, after the given event.
+        The caller stream then waits for the env stream, so that the outputs can be
+        used right away. Without event or on CPU, everything runs on the caller
+        stream.
+
+        The outputs allocated on the env stream are only reused by the next steps,
+        which are queued after the caller work using them.
+        """
+        if self.stream is None or inputs_ready is None:
+            yield
+            return
+
+        caller_stream = torch.cuda.current_stream(self.device)
+        self.stream.wait_event(inputs_ready)
+        with torch.cuda.stream(self.stream):
+            yield
+        caller_stream.wait_stream(self.stream)
+
+    def step_many(self, actions: torch.Tensor, lengths: torch.Tensor | None = None):
+        """Apply a sequence of actions to all instances.
+        Only the matches and the best boards are updated at each step, the other
+        infos are not recorded. The paths have different lengths, so the steps
+        are looped over and each of them is a single compiled call if asked for.
 
+        Null actions do not change the instances, they can be used as padding.
+
+        ---
+        Args:
+            actions: Batch of sequences of actions to apply.
+                Long tensor of shape of [batch_size, n_steps, actions]
+                where actions are a tuple (tile_id_1, tile_id_2, shift_1, shift_2).
+            lengths: Number of actual actions of each sequence, the remaining ones
+                being padding. Only used to count the steps played.
+                Long tensor of shape [batch_size,].
+        """
+        for step_id in range(actions.shape[1]):
+            self.replay_action(actions[:, step_id])
+
+        self.n_steps += actions.shape[1] if lengths is None else lengths
         self.update_best_env()
-        self.game_sample[self.current_sample_step] = self.instances[0].cpu()
-        self.current_sample_step = (self.current_sample_step + 1) % self.sample_size
 
-        # Rewards.
-        delta_rewards = (matches - previous_matches) / self.best_possible_matches
-        # best_delta_rewards = diff_matches / self.best_possible_matches
-        # best_delta_rewards[best_delta_rewards < 0] = 0
-        # done_rewards = (self.best_matches / self.best_possible_matches) * dones.float()
-        # done_rewards = (matches / self.best_possible_matches) * dones.float()
-        rewards = delta_rewards
+    def replay_action(self, actions: torch.Tensor):
+        """Apply the actions and keep track of the best boards.
+        Unlike `play_action`, no outcome is returned and the boards are updated
+        without any host sync.
 
-        infos = {
-            "just-won": just_won,
-            "n-steps": self.n_steps,
-            "best-boards": self.best_boards,
-            "best-matches": self.best_matches,
-        }
+        ---
+        Args:
+            actions: Batch of actions to apply.
+                Long tensor of shape of [batch_size, actions]
+                where actions are a tuple (tile_id_1, tile_id_2, shift_1, shift_2).
+        """
+        tiles_id_1, tiles_id_2 = actions[:, 0], actions[:, 1]
+        shifts_1, shifts_2 = actions[:, 2], actions[:, 3]
 
-        return self.render(), rewards, dones, truncated, infos
+        tile_ids = torch.stack((tiles_id_1, tiles_id_2), dim=1)
+        previous_local_matches = self.local_matches(tile_ids)
+        self.apply_action(tiles_id_1, shifts_1, tiles_id_2, shifts_2)
+        self.n_matches += self.local_matches(tile_ids) - previous_local_matches
 
-    def roll_tiles(self, tile_ids: torch.Tensor, shifts: torch.Tensor):
-        """Rolls tiles at the given ids for the given shifts.
-        It actually shifts all tiles, but with 0-shifts
-        except for the pointed tile ids.
+        improved = self.n_matches > self.best_matches
+        boards = self.boards_view(self.tiles).long()
+        self.best_boards.copy_(
+            torch.where(improved.view(-1, 1, 1, 1), boards, self.best_boards)
+        )
+        self.best_matches.copy_(torch.maximum(self.n_matches, self.best_matches))
+
+    def play_action(
+        self, actions: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Apply the actions and compute their outcome.
+        This is the hot path of a step, and it is compiled when asked for.
 
         ---
         Args:
-            tile_ids: The id of the tiles to roll.
+            actions: Batch of actions to apply.
+                Long tensor of shape of [batch_size, actions]
+                where actions are a tuple (tile_id_1, tile_id_2, shift_1, shift_2).
+
+        ---
+        Returns:
+            matches: The number of matches after the actions.
                 Shape of [batch_size,].
-            shifts: The number of shifts for each tile.
+            rewards: The number of matches gained by the environments.
+                Shape of [batch_size,].
+            just_won: Whether the environments has just been won.
+                Shape of [batch_size,].
+            dones: Whether the environments are terminated.
                 Shape of [batch_size,].
         """
-        total_shifts = torch.zeros(
-            self.batch_size * self.n_pieces, dtype=torch.long, device=self.device
-        )
-        offsets = torch.arange(
-            0, self.batch_size * self.n_pieces, self.n_pieces, device=self.device
-        )
-        total_shifts[tile_ids + offsets] = shifts
-
-        self.instances = rearrange(self.instances, "b c h w -> (b h w) c")
-        self.instances = EternityEnv.batched_roll(self.instances, total_shifts)
-        self.instances = rearrange(
-            self.instances,
-            "(b h w) c -> b c h w",
-            b=self.batch_size,
-            h=self.board_size,
-            w=self.board_size,
-        )
+        tiles_id_1, tiles_id_2 = actions[:, 0], actions[:, 1]
+        shifts_1, shifts_2 = actions[:, 2], actions[:, 3]
+
+        self.n_steps += 1
+
+        # Only the edges around the two tiles can change, so the matches
+        # are updated from the local matches instead of counting the whole board.
+        tile_ids = torch.stack((tiles_id_1, tiles_id_2), dim=1)
+        previous_local_matches = self.local_matches(tile_ids)
+        self.apply_action(tiles_id_1, shifts_1, tiles_id_2, shifts_2)
+
+        # Rewards are kept as integers, the normalization by the best possible
+        # matches is done once over the whole rollout.
+        rewards = self.local_matches(tile_ids) - previous_local_matches
+        matches = self.n_matches + rewards
+
+        just_won = matches == self.best_possible_matches
+        dones = self.n_steps >= self.episode_length
+        dones.bitwise_or_(just_won)
 
-    def swap_tiles(self, tile_ids_1: torch.Tensor, tile_ids_2: torch.Tensor):
-        """Swap two tiles in each element of the batch.
+        self.n_matches.copy_(matches)
+        return matches, rewards, just_won, dones
+
+    def apply_action(
+        self,
+        tile_ids_1: torch.Tensor,
+        shifts_1: torch.Tensor,
+        tile_ids_2: torch.Tensor,
+        shifts_2: torch.Tensor,
+    ):
+        """Rolls the two given tiles and then swap them, in-place.
+        Both tiles are read and written back with a single gather and
+        a single scatter, without changing the layout of the instances.
 
         ---
         Args:
-            tile_ids_1: The id of the first tiles to swap.
+            tile_ids_1: The id of the first tiles.
+                Shape of [batch_size,].
+            shifts_1: The number of shifts for the first tiles.
+                Shape of [batch_size,].
+            tile_ids_2: The id of the second tiles.
                 Shape of [batch_size,].
-            tile_ids_2: The id of the second tiles to swap.
+            shifts_2: The number of shifts for the second tiles.
                 Shape of [batch_size,].
         """
-        offsets = torch.arange(
-            0, self.batch_size * self.n_pieces, self.n_pieces, device=self.device
+        # When both ids are the same, the tile is rolled by both shifts.
+        same_tiles = tile_ids_1 == tile_ids_2
+        shifts = torch.stack(
+            (shifts_1 + same_tiles * shifts_2, shifts_2 + same_tiles * shifts_1), dim=1
         )
-        tile_ids_1 = tile_ids_1 + offsets
-        tile_ids_2 = tile_ids_2 + offsets
-        self.instances = rearrange(self.instances, "b c h w -> (b h w) c")
-        self.instances[tile_ids_1], self.instances[tile_ids_2] = (
-            self.instances[tile_ids_2],
-            self.instances[tile_ids_1],
-        )
-        self.instances = rearrange(
-            self.instances,
-            "(b h w) c -> b c h w",
-            b=self.batch_size,
-            h=self.board_size,
-            w=self.board_size,
+        tile_ids = torch.stack((tile_ids_1, tile_ids_2), dim=1)
+        batch_range = self.batch_range.unsqueeze(1)
+
+        # Shape of [batch_size, 2, N_SIDES].
+        tiles = self.roll_sides(self.tiles[batch_range, tile_ids], shifts)
+
+        # Write the rolled tiles at the place of each other.
+        # The tiles have been gathered into a new tensor, so this write can not read
+        # already overwritten tiles. Colliding ids are both written with the same
+        # tile, thanks to the shifts correction above.
+        self.tiles[batch_range, tile_ids.flip(dims=(1,))] = tiles
+
+    def roll_sides(self, tiles: torch.Tensor, shifts: torch.Tensor) -> torch.Tensor:
+        """Rolls the sides of the given tiles, in the same direction as `torch.roll`.
+
+        ---
+        Args:
+            tiles: The tiles to roll.
+                Shape of [batch_size, n_tiles, N_SIDES].
+            shifts: The number of shifts for each tile.
+                Shape of [batch_size, n_tiles].
+
+        ---
+        Returns:
+            The rolled tiles.
+                Shape of [batch_size, n_tiles, N_SIDES].
+        """
+        sides = self.roll_permutations[shifts % N_SIDES]
+        return torch.gather(tiles, dim=2, index=sides)
+
+    def local_matches(self, tile_ids: torch.Tensor) -> torch.Tensor:
+        """Count the matches of the edges around the given tiles.
+        An edge shared by multiple given tiles is only counted once.
+
+        ---
+        Args:
+            tile_ids: The id of the tiles.
+                Shape of [batch_size, n_tiles].
+
+        ---
+        Returns:
+            The number of matches around the tiles.
+                Shape of [batch_size,].
+        """
+        batch_size, n_tiles = tile_ids.shape
+        y, x = tile_ids // self.board_size, tile_ids % self.board_size
+
+        # Whether there is a neighbour for each side.
+        # Shape of [batch_size, n_tiles, N_SIDES].
+        valid_edges = torch.stack(
+            (y < self.board_size - 1, x < self.board_size - 1, y > 0, x > 0), dim=2
         )
+        neighbour_ids = tile_ids.unsqueeze(2) + self.neighbour_offsets
+        neighbour_ids = torch.where(valid_edges, neighbour_ids, tile_ids.unsqueeze(2))
+
+        batch_range = self.batch_range[:batch_size].view(batch_size, 1, 1)
+        sides = self.tiles[batch_range, tile_ids.unsqueeze(2), self.sides_range]
+        facing_sides = self.tiles[batch_range, neighbour_ids, self.facing_sides]
+        matches = (sides == facing_sides) & (sides != 0) & valid_edges
+
+        # An edge is identified by its southern or western tile and its orientation.
+        edge_ids = 2 * torch.minimum(tile_ids.unsqueeze(2), neighbour_ids)
+        edge_ids += self.sides_range % 2
+        edge_ids = torch.where(valid_edges, edge_ids, -1)
+
+        # Remove the duplicated edges, which are next to each other once sorted.
+        edge_ids, order = edge_ids.flatten(start_dim=1).sort(dim=1)
+        matches = torch.gather(matches.flatten(start_dim=1), dim=1, index=order)
+        matches[:, 1:] &= edge_ids[:, 1:] != edge_ids[:, :-1]
+
+        return matches.sum(dim=1)
 
     @property
     def matches(self) -> torch.Tensor:
         """The number of matches for each instance.
-        Uses convolutions to vectorize the computations.
-
-        The main idea is to compute the sum $class_id_1 - class_id_2$,
-        where "1" and "2" represents two neighbour tiles.
-        If this sum equals to 0, then the class_id are the same.
-
-        We still have to make sure that we're not computing 0-0 matchings,
-        so we also compute $class_id_1 + class_id_2$ and check if this is equal
-        to 0 (which would mean that both class_id are equal to 0).
 
         ---
         Returns:
             The number of matches for each instance.
                 Shape of [batch_size,].
         """
-        return EternityEnv.count_matches(self.instances)
+        return EternityEnv.count_matches(self.boards_view(self.tiles))
+
+    @property
+    def instances(self) -> torch.Tensor:
+        """The instances in the board layout.
+
+        ---
+        Returns:
+            A copy of the instances.
+                Long tensor of shape [batch_size, N_SIDES, size, size].
+        """
+        return self.boards_view(self.tiles).to(
+            torch.long, memory_format=torch.contiguous_format
+        )
+
+    def boards_view(self, tiles: torch.Tensor) -> torch.Tensor:
+        """View the given tiles in the board layout, without copying them.
+
+        ---
+        Args:
+            tiles: The tiles to view.
+                Shape of [batch_size, n_pieces, N_SIDES].
+
+        ---
+        Returns:
+            The view of the tiles.
+                Shape of [batch_size, N_SIDES, size, size].
+        """
+        return tiles.view(
+            tiles.shape[0], self.board_size, self.board_size, N_SIDES
+        ).permute(0, 3, 1, 2)
 
     def scramble_instances(self, instance_ids: torch.Tensor):
         """Scrambles the instances to start from a new valid configuration.
@@ -323,43 +525,26 @@ class EternityEnv(gym.Env):
             instance_ids: The ids of the instances to scramble.
                 Shape of [instances,].
         """
-        # Scrambles the tiles.
-        self.instances = rearrange(self.instances, "b s h w -> b (h w) s")
-        permutations = torch.arange(start=0, end=self.n_pieces, device=self.device)
-        permutations = repeat(
-            permutations, "p -> b p s", b=self.batch_size, s=N_SIDES
-        ).clone()
-
-        for instance_id in instance_ids:
-            perm = torch.randperm(self.n_pieces, generator=self.rng, device=self.device)
-            perm = repeat(perm, "p -> p s", s=N_SIDES)
-            permutations[instance_id] = perm
+        n_instances = instance_ids.shape[0]
+        tiles = self.tiles[instance_ids]
 
-        self.instances = torch.gather(self.instances, dim=1, index=permutations)
+        # Scrambles the tiles.
+        # Sorting random keys gives an independent permutation for each instance.
+        permutations = torch.rand(
+            (n_instances, self.n_pieces), generator=self.rng, device=self.device
+        ).argsort(dim=1)
+        permutations = repeat(permutations, "b p -> b p s", s=N_SIDES)
+        tiles = torch.gather(tiles, dim=1, index=permutations)
 
         # Randomly rolls the tiles.
-        self.instances = rearrange(self.instances, "b p s -> (b p) s")
-        shifts = torch.zeros(
-            self.batch_size * self.n_pieces, dtype=torch.long, device=self.device
-        )
-        mask = torch.zeros(self.batch_size, dtype=torch.bool, device=self.device)
-        mask[instance_ids] = True
-        mask = torch.repeat_interleave(mask, self.n_pieces)
-        shifts[mask] = torch.randint(
+        shifts = torch.randint(
             low=0,
             high=N_SIDES,
-            size=(instance_ids.shape[0] * self.n_pieces,),
+            size=(n_instances, self.n_pieces),
             generator=self.rng,
             device=self.device,
         )
-        self.instances = EternityEnv.batched_roll(self.instances, shifts)
-        self.instances = rearrange(
-            self.instances,
-            "(b h w) s -> b s h w",
-            b=self.batch_size,
-            h=self.board_size,
-            w=self.board_size,
-        )
+        self.tiles[instance_ids] = self.roll_sides(tiles, shifts)
 
     def render(self, mode: str = "computer") -> torch.Tensor:
         """Render the environment.
@@ -372,6 +557,7 @@ class EternityEnv(gym.Env):
         ---
         Returns:
             The observation of shape [batch_size, N_SIDES, size, size].
+            It is a copy, since the tiles are modified in-place by the steps.
         """
         match mode:
             case "computer":
@@ -382,13 +568,15 @@ class EternityEnv(gym.Env):
     def update_best_env(self):
         """Finds the best env of the current batch
         and updates the best env if the new one is better.
+        The best boards of each instance are used, so that the boards seen
+        between two updates are not missed.
         """
-        best_env_id = self.matches.argmax()
-        best_matches_found = self.matches[best_env_id].cpu().item()
+        best_env_id = self.best_matches.argmax()
+        best_matches_found = self.best_matches[best_env_id].cpu().item()
 
         if self.best_matches_ever < best_matches_found:
             self.best_matches_ever = best_matches_found
-            self.best_board_ever = self.instances[best_env_id].cpu()
+            self.best_board_ever = self.best_boards[best_env_id].to("cpu", copy=True)
 
     def save_best_env(self, filepath: Path | str):
         """Render the best environment and save it on disk."""
@@ -413,51 +601,20 @@ class EternityEnv(gym.Env):
             The matches.
                 Long tensor of shape [batch_size,].
         """
-        n_matches = torch.zeros(instances.shape[0], device=instances.device)
-
-        for conv in [HORIZONTAL_CONV, VERTICAL_CONV]:
-            res = torch.conv2d(instances.float(), conv.to(instances.device))
-            n_matches += (res == 0).float().flatten(start_dim=1).sum(dim=1)
+        # Compare each side with the facing side of its neighbour.
+        # Don't forget that the y-axis is reversed!!
+        north_sides = instances[:, NORTH, :-1, :]
+        vertical_matches = north_sides == instances[:, SOUTH, 1:, :]
+        vertical_matches &= north_sides != 0  # Ignore walls.
 
-        # Remove the 0-0 matches from the count.
-        for conv in [HORIZONTAL_ZERO_CONV, VERTICAL_ZERO_CONV]:
-            res = torch.conv2d(instances.float(), conv.to(instances.device))
-            n_matches -= (res == 0).float().flatten(start_dim=1).sum(dim=1)
+        east_sides = instances[:, EAST, :, :-1]
+        horizontal_matches = east_sides == instances[:, WEST, :, 1:]
+        horizontal_matches &= east_sides != 0  # Ignore walls.
 
-        return n_matches.long()
-
-    @staticmethod
-    def batched_roll(input_tensor: torch.Tensor, shifts: torch.Tensor) -> torch.Tensor:
-        """Batched version of `torch.roll`.
-        It applies a circular shifts to the last dimension of the tensor.
-
-        ---
-        Args:
-            input_tensor: The tensor to roll.
-                Shape of [batch_size, hidden_size].
-            shifts: The number of shifts for each element of the batch.
-                Shape of [batch_size,].
-
-        ---
-        Returns:
-            The rolled tensor.
-        """
-        batch_size, hidden_size = input_tensor.shape
-        # In the right range of values (circular shift).
-        shifts = shifts % hidden_size
-        # To match the same direction as `torch.roll`.
-        shifts = hidden_size - shifts
-
-        # Compute the indices that will select the right part of the extended tensor.
-        offsets = torch.arange(hidden_size, device=input_tensor.device)
-        offsets = repeat(offsets, "h -> b h", b=batch_size)
-        select_indices = shifts.unsqueeze(1) + offsets
-
-        # Extend the input tensor with circular padding.
-        input_tensor = torch.concat((input_tensor, input_tensor), dim=1)
-
-        rolled_tensor = torch.gather(input_tensor, dim=1, index=select_indices)
-        return rolled_tensor
+        # Reduce the bool masks directly, without any float cast.
+        n_matches = vertical_matches.sum(dim=(1, 2))
+        n_matches += horizontal_matches.sum(dim=(1, 2))
+        return n_matches
 
     @classmethod
     def from_env(
@@ -473,6 +630,8 @@ class EternityEnv(gym.Env):
             env.device,
             env.rng.seed(),
             env.sample_size,
+            env.compile,
+            env.n_classes,
         )
         copy.n_steps = env.n_steps.clone()
         copy.best_matches = env.best_matches.clone()
@@ -505,6 +664,8 @@ class EternityEnv(gym.Env):
             env.device,
             env.rng.seed(),
             env.sample_size,
+            env.compile,
+            env.n_classes,
         )
         copy.n_steps = n_steps
         copy.best_matches = best_matches
@@ -523,10 +684,19 @@ class EternityEnv(gym.Env):
         batch_size: int,
         device: str = "cpu",
         seed: int = 0,
+        compile: bool = False,
     ) -> "EternityEnv":
         instance = read_instance_file(instance_path)
+        n_classes = int(instance.max().item() + 1)  # Still on CPU, no sync.
         instances = repeat(instance, "c h w -> b c h w", b=batch_size)
-        return cls(instances, episode_length, device, seed)
+        return cls(
+            instances,
+            episode_length,
+            device,
+            seed,
+            compile=compile,
+            n_classes=n_classes,
+        )
 
 
 def read_instance_file(instance_path: Path | str) -> torch.Tensor:
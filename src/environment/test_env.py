@@ -148,13 +148,16 @@ def test_batch_scramble(instance_path: str):
         assert torch.all(env.instances[instance_id] == reference)
 
 
-def test_batch_roll():
-    input_tensor = torch.randn((10, 5))
-    shifts = torch.randint(low=-15, high=15, size=(len(input_tensor),))
-    rolled_tensor = EternityEnv.batched_roll(input_tensor, shifts)
-
-    for inpt, shift, rolled in zip(input_tensor, shifts, rolled_tensor):
-        assert torch.all(torch.roll(inpt, shift.item()) == rolled)
+def test_roll_sides():
+    env = EternityEnv.from_file(ENV_DIR / "eternity_A.txt", 10, 10, device="cpu")
+    tiles = torch.randint(low=0, high=10, size=(env.batch_size, 3, N_SIDES))
+    shifts = torch.randint(low=-15, high=15, size=(env.batch_size, 3))
+    rolled_tiles = env.roll_sides(tiles, shifts)
+
+    for tile, shift, rolled in zip(
+        tiles.flatten(0, 1), shifts.flatten(), rolled_tiles.flatten(0, 1)
+    ):
+        assert torch.all(torch.roll(tile, shift.item()) == rolled)
 
 
 @pytest.mark.parametrize(
@@ -170,7 +173,8 @@ def test_batch_roll_action(instance_path):
     instance_reference = env.instances[0].clone()
     tile_ids = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
     shifts = torch.randint(low=0, high=N_SIDES, size=(env.batch_size,))
-    env.roll_tiles(tile_ids, shifts)
+    # Swapping a tile with itself only rolls it.
+    env.apply_action(tile_ids, shifts, tile_ids, torch.zeros_like(shifts))
 
     for instance_rolled, tile_id, shift in zip(env.instances, tile_ids, shifts):
         coords = (tile_id.item() // env.board_size, tile_id.item() % env.board_size)
@@ -195,7 +199,9 @@ def test_batch_swap_action(instance_path):
     instance_reference = env.instances[0].clone()
     tile_ids_1 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
     tile_ids_2 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
-    env.swap_tiles(tile_ids_1, tile_ids_2)
+    tile_ids_2[:2] = tile_ids_1[:2]  # Swapping a tile with itself changes nothing.
+    no_shifts = torch.zeros_like(tile_ids_1)
+    env.apply_action(tile_ids_1, no_shifts, tile_ids_2, no_shifts)
 
     for instance_swapped, tile_id_1, tile_id_2 in zip(
         env.instances, tile_ids_1, tile_ids_2
@@ -214,6 +220,43 @@ def test_batch_swap_action(instance_path):
         assert torch.all(instance_copy == instance_swapped)
 
 
+@pytest.mark.parametrize(
+    "instance_path",
+    [
+        "eternity_trivial_A.txt",
+        "eternity_trivial_B.txt",
+        "eternity_A.txt",
+    ],
+)
+def test_apply_action(instance_path: str):
+    env = EternityEnv.from_file(ENV_DIR / instance_path, 10, 10, device="cpu")
+    env.reset()
+    instances_reference = env.instances.clone()
+    tile_ids_1 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
+    tile_ids_2 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
+    tile_ids_2[:2] = tile_ids_1[:2]  # Make sure some tiles are the same.
+    shifts_1 = torch.randint(low=0, high=N_SIDES, size=(env.batch_size,))
+    shifts_2 = torch.randint(low=0, high=N_SIDES, size=(env.batch_size,))
+    env.apply_action(tile_ids_1, shifts_1, tile_ids_2, shifts_2)
+
+    for instance_id, instance in enumerate(instances_reference):
+        coords = [
+            (c.item() // env.board_size, c.item() % env.board_size)
+            for c in [tile_ids_1[instance_id], tile_ids_2[instance_id]]
+        ]
+        shifts = [shifts_1[instance_id].item(), shifts_2[instance_id].item()]
+
+        for (y, x), shift in zip(coords, shifts):
+            instance[:, y, x] = torch.roll(instance[:, y, x], shift)
+
+        (y_1, x_1), (y_2, x_2) = coords
+        tile = instance[:, y_1, x_1].clone()
+        instance[:, y_1, x_1] = instance[:, y_2, x_2]
+        instance[:, y_2, x_2] = tile
+
+        assert torch.all(instance == env.instances[instance_id])
+
+
 @pytest.mark.parametrize(
     "instance_1, instance_2",
     [
@@ -298,3 +341,128 @@ def test_best_boards(instance_path: str):
 
         assert torch.all(infos["best-boards"] == best_boards)
         assert torch.all(infos["best-matches"] == best_scores)
+
+
+@pytest.mark.parametrize(
+    "instance_path",
+    [
+        "eternity_trivial_A.txt",
+        "eternity_A.txt",
+    ],
+)
+def test_compiled_step(instance_path: str):
+    env = EternityEnv.from_file(
+        ENV_DIR / instance_path, episode_length=10, batch_size=10, device="cpu"
+    )
+    env.reset()
+    compiled_env = EternityEnv(env.instances, episode_length=10, compile=True)
+
+    for _ in range(5):
+        tile_ids_1 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
+        tile_ids_2 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
+        shifts_1 = torch.randint(low=0, high=4, size=(env.batch_size,))
+        shifts_2 = torch.randint(low=0, high=4, size=(env.batch_size,))
+        actions = torch.stack([tile_ids_1, tile_ids_2, shifts_1, shifts_2], dim=1)
+
+        _, rewards, *_ = env.step(actions)
+        _, compiled_rewards, *_ = compiled_env.step(actions)
+
+        assert torch.all(env.instances == compiled_env.instances)
+        assert torch.all(rewards == compiled_rewards)
+
+
+@pytest.mark.parametrize(
+    "instance_path",
+    [
+        "eternity_trivial_A.txt",
+        "eternity_trivial_B.txt",
+        "eternity_A.txt",
+    ],
+)
+def test_incremental_matches(instance_path: str):
+    env = EternityEnv.from_file(
+        ENV_DIR / instance_path, episode_length=100, batch_size=10, device="cpu"
+    )
+    env.reset()
+
+    for _ in range(100):
+        tile_ids_1 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
+        tile_ids_2 = torch.randint(low=0, high=env.n_pieces, size=(env.batch_size,))
+        shifts_1 = torch.randint(low=0, high=4, size=(env.batch_size,))
+        shifts_2 = torch.randint(low=0, high=4, size=(env.batch_size,))
+
+        # Make sure we have the same and the neighbouring tiles in the batch.
+        tile_ids_2[0] = tile_ids_1[0]
+        tile_ids_2[1] = (tile_ids_1[1] + 1) % env.n_pieces
+        tile_ids_2[2] = (tile_ids_1[2] + env.board_size) % env.n_pieces
+
+        actions = torch.stack([tile_ids_1, tile_ids_2, shifts_1, shifts_2], dim=1)
+        previous_matches = env.matches
+        _, rewards, *_ = env.step(actions)
+
+        assert torch.all(env.n_matches == env.matches)
+        assert torch.all(rewards == env.matches - previous_matches)
+
+
+@pytest.mark.parametrize(
+    "instance_path",
+    [
+        "eternity_trivial_A.txt",
+        "eternity_A.txt",
+    ],
+)
+def test_step_many(instance_path: str):
+    env = EternityEnv.from_file(
+        ENV_DIR / instance_path, episode_length=100, batch_size=10, device="cpu"
+    )
+    env.reset()
+    replayed_env = EternityEnv.from_env(env)
+
+    n_steps = 5
+    tile_ids = torch.randint(
+        low=0, high=env.n_pieces, size=(env.batch_size, n_steps, 2)
+    )
+    shifts = torch.randint(low=0, high=4, size=(env.batch_size, n_steps, 2))
+    actions = torch.cat((tile_ids, shifts), dim=2)
+
+    # The last actions of some sequences are null padding.
+    lengths = torch.randint(low=0, high=n_steps + 1, size=(env.batch_size,))
+    padding = torch.arange(n_steps).unsqueeze(0) >= lengths.unsqueeze(1)
+    actions[padding] = 0
+
+    for step_id in range(n_steps):
+        env.step(actions[:, step_id])
+    env.n_steps -= n_steps - lengths
+
+    replayed_env.step_many(actions, lengths)
+
+    assert torch.all(replayed_env.instances == env.instances)
+    assert torch.all(replayed_env.n_matches == env.n_matches)
+    assert torch.all(replayed_env.n_steps == env.n_steps)
+
+    # The best boards seen along the sequences are tracked as with `step`.
+    assert torch.all(replayed_env.best_matches == env.best_matches)
+    assert torch.all(replayed_env.best_boards == env.best_boards)
+    assert replayed_env.best_matches_ever == env.best_matches_ever
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Requires a GPU.")
+def test_step_on_env_stream():
+    env = EternityEnv.from_file(
+        ENV_DIR / "eternity_A.txt", episode_length=100, batch_size=10, device="cuda"
+    )
+    env.reset()
+    stream_env = EternityEnv.from_env(env)
+
+    for _ in range(5):
+        tile_ids = torch.randint(
+            low=0, high=env.n_pieces, size=(env.batch_size, 2), device="cuda"
+        )
+        shifts = torch.randint(low=0, high=4, size=(env.batch_size, 2), device="cuda")
+        actions = torch.cat((tile_ids, shifts), dim=1)
+
+        _, rewards, *_ = env.step(actions)
+        _, stream_rewards, *_ = stream_env.step(actions, stream_env.record_event())
+
+        assert torch.all(stream_rewards == rewards)
+        assert torch.all(stream_env.instances == env.instances)
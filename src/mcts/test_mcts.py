@@ -1,3 +1,5 @@
+import math
+
 import pytest
 import torch
 from einops import rearrange, repeat
@@ -64,7 +66,7 @@ def tree_mockup() -> MCTSTree:
     policy, critic = models_mockup(env)
     tree = MCTSTree(env, policy, critic, simulations=2, childs=3)
     assert tree.n_nodes == 7
-    tree.childs = torch.LongTensor(
+    tree.childs[:] = torch.LongTensor(
         [
             [
                 [1, 2, 3],
@@ -86,13 +88,41 @@ def tree_mockup() -> MCTSTree:
             ],
         ]
     )
-    tree.parents = torch.LongTensor(
+    tree.parents[:] = torch.LongTensor(
         [
             [0, 0, 0, 0, 1, 1, 0],
             [0, 0, 0, 0, 0, 0, 0],
         ]
     )
-    tree.actions = torch.LongTensor(
+    tree.ancestors[:] = torch.LongTensor(
+        [
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 2, 0],
+                [0, 3, 0],
+                [0, 1, 4],
+                [0, 1, 5],
+                [0, 0, 0],
+            ],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 2, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+            ],
+        ]
+    )
+    tree.depths[:] = torch.LongTensor(
+        [
+            [0, 1, 1, 1, 2, 2, 0],
+            [0, 1, 1, 0, 0, 0, 0],
+        ]
+    )
+    tree.actions[:] = torch.LongTensor(
         [
             [
                 [0, 0, 0, 0],
@@ -102,7 +132,6 @@ def tree_mockup() -> MCTSTree:
                 [2, 7, 3, 1],
                 [1, 3, 0, 0],
                 [0, 0, 0, 0],
-                [0, 0, 0, 0],
             ],
             [
                 [0, 0, 0, 0],
@@ -112,23 +141,22 @@ def tree_mockup() -> MCTSTree:
                 [0, 0, 0, 0],
                 [0, 0, 0, 0],
                 [0, 0, 0, 0],
-                [0, 0, 0, 0],
             ],
         ],
     )
-    tree.visits = torch.LongTensor(
+    tree.visits[:] = torch.LongTensor(
         [
             [4, 2, 1, 1, 1, 1, 0],
             [2, 1, 1, 0, 0, 0, 0],
         ]
     )
-    tree.sum_scores = torch.FloatTensor(
+    tree.sum_scores[:] = torch.FloatTensor(
         [
             [3.0, 2.0, 0.6, 0.4, 1.0, 1.0, 0.0],
             [2.0, 1.1, 0.9, 0.0, 0.0, 0.0, 0.0],
         ]
     )
-    tree.terminated = torch.BoolTensor(
+    tree.terminated[:] = torch.BoolTensor(
         [
             [False, False, False, False, True, False, False],
             [False, True, True, False, False, False, False],
@@ -155,7 +183,7 @@ def tree_mockup_small() -> MCTSTree:
     policy, critic = models_mockup(env)
     tree = MCTSTree(env, policy, critic, simulations=2, childs=3)
     assert tree.n_nodes == 7
-    tree.childs = torch.LongTensor(
+    tree.childs[:] = torch.LongTensor(
         [
             [
                 [1, 2, 3],
@@ -177,13 +205,41 @@ def tree_mockup_small() -> MCTSTree:
             ],
         ]
     )
-    tree.parents = torch.LongTensor(
+    tree.parents[:] = torch.LongTensor(
         [
             [0, 0, 0, 0, 0, 0, 0],
             [0, 0, 0, 0, 0, 0, 0],
         ]
     )
-    tree.actions = torch.LongTensor(
+    tree.ancestors[:] = torch.LongTensor(
+        [
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 2, 0],
+                [0, 3, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+            ],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0],
+            ],
+        ]
+    )
+    tree.depths[:] = torch.LongTensor(
+        [
+            [0, 1, 1, 1, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0],
+        ]
+    )
+    tree.actions[:] = torch.LongTensor(
         [
             [
                 [0, 0, 0, 0],
@@ -193,7 +249,6 @@ def tree_mockup_small() -> MCTSTree:
                 [0, 0, 0, 0],
                 [0, 0, 0, 0],
                 [0, 0, 0, 0],
-                [0, 0, 0, 0],
             ],
             [
                 [0, 0, 0, 0],
@@ -203,23 +258,22 @@ def tree_mockup_small() -> MCTSTree:
                 [0, 0, 0, 0],
                 [0, 0, 0, 0],
                 [0, 0, 0, 0],
-                [0, 0, 0, 0],
             ],
         ],
     )
-    tree.visits = torch.LongTensor(
+    tree.visits[:] = torch.LongTensor(
         [
             [4, 2, 1, 1, 0, 0, 0],
             [0, 0, 0, 0, 0, 0, 0],
         ]
     )
-    tree.sum_scores = torch.FloatTensor(
+    tree.sum_scores[:] = torch.FloatTensor(
         [
             [3.0, 2.0, 0.6, 0.4, 0.0, 0.0, 0.0],
             [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
         ]
     )
-    tree.terminated = torch.BoolTensor(
+    tree.terminated[:] = torch.BoolTensor(
         [
             [False, False, False, False, False, False, False],
             [False, False, False, False, False, False, False],
@@ -247,22 +301,18 @@ def tree_mockup_small() -> MCTSTree:
 )
 def test_ucb(nodes: torch.Tensor):
     tree = tree_mockup()
-    c = torch.sqrt(torch.Tensor([2]))
-    ucb = torch.zeros_like(nodes, dtype=torch.float)
-    for batch_id in range(nodes.shape[0]):
-        for ucb_index, node_id in enumerate(nodes[batch_id]):
-            node_visits = tree.visits[batch_id, node_id]
-
-            if node_visits == 0:
-                ucb[batch_id, ucb_index] = torch.inf
-                continue
-
-            parent_id = tree.parents[batch_id, node_id]
-            parent_visits = tree.visits[batch_id, parent_id]
-            node_score = tree.sum_scores[batch_id, node_id] / node_visits
-            ucb[batch_id, ucb_index] = node_score + c * torch.sqrt(
-                torch.log(parent_visits) / node_visits
-            )
+    c = math.sqrt(2)
+
+    node_visits = torch.gather(tree.visits, dim=1, index=nodes)
+    parent_ids = torch.gather(tree.parents, dim=1, index=nodes)
+    parent_visits = torch.gather(tree.visits, dim=1, index=parent_ids)
+    sum_scores = torch.gather(tree.sum_scores, dim=1, index=nodes)
+
+    visited_visits = node_visits.clamp(min=1)
+    ucb = sum_scores / visited_visits + c * torch.sqrt(
+        torch.log(parent_visits) / visited_visits
+    )
+    ucb = torch.where(node_visits == 0, torch.inf, ucb)
 
     assert torch.allclose(ucb, tree.ucb_scores(nodes)), "Wrong UCB scores"
 
@@ -277,36 +327,19 @@ def test_ucb(nodes: torch.Tensor):
 def test_select_childs(nodes: torch.Tensor):
     tree = tree_mockup()
 
-    childs = []
-    terminated = []
-    for batch_id, node_id in enumerate(nodes):
-        childs.append(tree.childs[batch_id, node_id])
-
-        terminated.append([])
-        for child_id in childs[-1]:
-            terminated[-1].append(tree.terminated[batch_id, child_id])
-        terminated[-1] = torch.BoolTensor(terminated[-1])
-
-    childs = torch.stack(childs, dim=0)
-    terminated = torch.stack(terminated, dim=0)
+    childs = tree.childs[tree.batch_range, nodes]
+    terminated = torch.gather(tree.terminated, dim=1, index=childs)
 
     ucb = tree.ucb_scores(childs)
     ucb[childs == 0] = -torch.inf
     ucb[terminated] = -torch.inf
     best_childs_ids = torch.argmax(ucb, dim=1)
-    best_childs = torch.stack(
-        [
-            childs[batch_id, best_childs_id]
-            for batch_id, best_childs_id in enumerate(best_childs_ids)
-        ],
-        dim=0,
-    )
+    best_childs = torch.gather(childs, dim=1, index=best_childs_ids.unsqueeze(1))
+    best_childs = best_childs.squeeze(1)
 
     # Make sure we do not change the value of a leaf node.
-    for batch_id, child_ids in enumerate(childs):
-        if torch.all(child_ids == 0):
-            # No childs !
-            best_childs[batch_id] = nodes[batch_id]
+    no_child = torch.all(childs == 0, dim=1)
+    best_childs = torch.where(no_child, nodes, best_childs)
 
     assert torch.all(best_childs == tree.select_childs(nodes))
 
@@ -329,39 +362,23 @@ def test_select_leafs(tree: MCTSTree):
         envs.instances != tree.envs.instances
     ), "Tree instances have changed"
 
-    for batch_id in range(tree.batch_size):
-        actions = []
-        copy_envs = EternityEnv.from_env(tree.envs)
+    # Walk up the parents of all leafs at once, independently of the ancestors.
+    # The envs already at their roots are given null actions, which do not
+    # change them.
+    actions = []
+    current_nodes = leafs.clone()
+    while torch.any(current_nodes != 0):
+        node_actions = tree.actions[tree.batch_range, current_nodes]
+        is_root = (current_nodes == 0).unsqueeze(1)
+        actions.append(torch.where(is_root, 0, node_actions))
+        current_nodes = tree.parents[tree.batch_range, current_nodes]
 
-        current_node = leafs[batch_id]
-        while current_node != 0:
-            actions.append(tree.actions[batch_id, current_node])
-            current_node = tree.parents[batch_id, current_node]
+    # Simulate all actions from the roots and compare the final envs.
+    copy_envs = EternityEnv.from_env(tree.envs)
+    for step_actions in reversed(actions):
+        copy_envs.step(step_actions)
 
-        if len(actions) == 0:
-            assert torch.all(
-                copy_envs.instances[batch_id] == envs.instances[batch_id]
-            ), "Replayed instances differ"
-            continue
-
-        # Shape of [n_actions, action_shape].
-        actions = torch.stack(list(reversed(actions)))
-
-        # Build the fictive actions for the other envs.
-        all_actions = torch.zeros(
-            (copy_envs.batch_size, actions.shape[0], actions.shape[1]),
-            dtype=torch.long,
-            device=copy_envs.device,
-        )
-        all_actions[batch_id] = actions
-
-        # Simulate all actions and compare the final env with the given envs.
-        for step_id in range(all_actions.shape[1]):
-            copy_envs.step(all_actions[:, step_id])
-
-        assert torch.all(
-            copy_envs.instances[batch_id] == envs.instances[batch_id]
-        ), "Replayed instances differ"
+    assert torch.all(copy_envs.instances == envs.instances), "Replayed instances differ"
 
 
 @pytest.mark.parametrize(
@@ -394,6 +411,17 @@ def test_expand_nodes(nodes: torch.Tensor):
             ), "Wrong child id"
 
             assert tree.parents[batch_id, child_id] == node_id, "Wrong parent id"
+            assert (
+                tree.depths[batch_id, child_id] == tree.depths[batch_id, node_id] + 1
+            ), "Wrong child depth"
+            assert torch.all(
+                tree.ancestors[batch_id, child_id, : tree.depths[batch_id, child_id]]
+                == tree.ancestors[batch_id, node_id, : tree.depths[batch_id, child_id]]
+            ), "Wrong child path"
+            assert (
+                tree.ancestors[batch_id, child_id, tree.depths[batch_id, child_id]]
+                == child_id
+            ), "Wrong child path"
 
             assert torch.all(
                 tree.actions[batch_id, child_id] == actions[batch_id, child_number]
@@ -1,3 +1,5 @@
+import math
+
 import torch
 from einops import rearrange, repeat
 from tqdm import tqdm
@@ -27,7 +29,7 @@ class MCTSTree:
         self.device = self.envs.device
 
         self.batch_range = torch.arange(self.batch_size, device=self.device)
-        self.c_ucb = torch.sqrt(torch.FloatTensor([2])).to(self.device)
+        self.c_ucb = math.sqrt(2)
 
         self.childs = torch.zeros(
             (self.batch_size, self.n_nodes, self.n_childs),
@@ -59,6 +61,19 @@ class MCTSTree:
             dtype=torch.bool,
             device=self.device,
         )
+        # Path from the root to each node, indexed by depth. The path is padded
+        # with the root node, whose action does not change the envs.
+        # A tree can not be deeper than its number of simulations.
+        self.ancestors = torch.zeros(
+            (self.batch_size, self.n_nodes, self.n_simulations + 1),
+            dtype=torch.long,
+            device=self.device,
+        )
+        self.depths = torch.zeros(
+            (self.batch_size, self.n_nodes),
+            dtype=torch.long,
+            device=self.device,
+        )
 
     def reset(self, envs: EternityEnv, policy: Policy, critic: Critic):
         """Reset the overall object state.
@@ -79,6 +94,8 @@ class MCTSTree:
         self.visits.zero_()
         self.sum_scores.zero_()
         self.terminated.zero_()
+        self.ancestors.zero_()
+        self.depths.zero_()
 
     @torch.inference_mode()
     def evaluate(self, disable_logs: bool) -> torch.Tensor:
@@ -178,14 +195,12 @@ class MCTSTree:
         parent_visits = torch.gather(self.visits, dim=1, index=parent_nodes)
         sum_scores = torch.gather(self.sum_scores, dim=1, index=nodes)
 
-        corrected_node_visits = node_visits.clone()
-        corrected_node_visits[node_visits == 0] = 1  # Avoid division by 0.
+        corrected_node_visits = node_visits.clamp(min=1)  # Avoid division by 0.
 
         ucb = sum_scores / corrected_node_visits + self.c_ucb * torch.sqrt(
             torch.log(parent_visits) / corrected_node_visits
         )
-        ucb[node_visits == 0] = torch.inf
-        return ucb
+        return torch.where(node_visits == 0, torch.inf, ucb)
 
     def scores(self, nodes: torch.Tensor) -> torch.Tensor:
         """Compute the mean score of the given nodes.
@@ -224,15 +239,13 @@ class MCTSTree:
 
         # Ignore terminated or fictive childs.
         terminated = torch.gather(self.terminated, dim=1, index=childs)
-        ucb[terminated | (childs == 0)] = -torch.inf
+        ucb.masked_fill_(terminated | (childs == 0), -torch.inf)
 
         best_childs = childs[self.batch_range, torch.argmax(ucb, dim=1)]
 
         # If a node has no child, it remains unchanged.
-        no_child = (childs != 0).sum(dim=1) == 0
-        best_childs[no_child] = nodes[no_child]
-
-        return best_childs
+        no_child = torch.all(childs == 0, dim=1)
+        return torch.where(no_child, nodes, best_childs)
 
     def select_leafs(self) -> tuple[torch.Tensor, EternityEnv]:
         """Iteratively dive to select the leaf to expand in each environment.
@@ -245,23 +258,27 @@ class MCTSTree:
         """
         # Start with the root nodes.
         nodes = torch.zeros(self.batch_size, dtype=torch.long, device=self.device)
-        envs = EternityEnv.from_env(self.envs)
 
         # Iterate until all selected nodes have no childs.
+        # The nodes of the leafs are left unchanged by `select_childs`.
+        n_levels = 0
         leafs = (self.childs[self.batch_range, nodes] != 0).sum(dim=1) == 0
         while not torch.all(leafs):
             nodes = self.select_childs(nodes)
-            actions = self.actions[self.batch_range, nodes]
-
-            # Some of the actions may come from leafs.
-            # Those actions have to be ignored so that its env is unchanged.
-            # WARNING: This should be modified appropriately with the env.
-            actions[leafs] = 0  # If actions are null, the puzzle will not change.
-            envs.n_steps[leafs] -= 1
-            envs.step(actions)
-
+            n_levels += 1
             leafs = (self.childs[self.batch_range, nodes] != 0).sum(dim=1) == 0
 
+        # Replay the whole paths at once. The paths are padded with the root node,
+        # whose actions are null and do not change the envs.
+        paths = self.ancestors[self.batch_range, nodes, 1 : n_levels + 1]
+        actions = torch.gather(
+            self.actions,
+            dim=1,
+            index=repeat(paths, "b d -> b d a", a=self.actions.shape[2]),
+        )
+        envs = EternityEnv.from_env(self.envs)
+        envs.step_many(actions, lengths=self.depths[self.batch_range, nodes])
+
         return nodes, envs
 
     def sample_nodes(self, envs: EternityEnv) -> torch.Tensor:
@@ -321,6 +338,7 @@ class MCTSTree:
         - Be added to the list of childs of its father.
         - Have its parent set.
         - Have its actions set.
+        - Have its path and depth set.
         - Add one to the number of nodes in the tree.
 
         ---
@@ -361,6 +379,17 @@ class MCTSTree:
         self.visits.scatter_(dim=1, index=childs_node_id, src=ones)
         self.terminated.scatter_(dim=1, index=childs_node_id, src=terminated)
 
+        # Add the paths, made of the path of their parent followed by themselves.
+        batch_range = self.batch_range.unsqueeze(1)
+        depths = self.depths[self.batch_range, nodes] + 1
+        paths = repeat(
+            self.ancestors[self.batch_range, nodes], "b d -> b c d", c=self.n_childs
+        ).clone()
+        depth_ids = repeat(depths, "b -> b c 1", c=self.n_childs)
+        paths.scatter_(dim=2, index=depth_ids, src=childs_node_id.unsqueeze(2))
+        self.ancestors[batch_range, childs_node_id] = paths
+        self.depths[batch_range, childs_node_id] = depths.unsqueeze(1)
+
         # Add the actions.
         childs_node_id = repeat(childs_node_id, "b c -> b c a", a=actions.shape[2])
         self.actions.scatter_(dim=1, index=childs_node_id, src=actions)
@@ -1,2 +1,3 @@
 from .policy import Policy
 from .critic import Critic
+from .cuda_graph import CUDAGraphModule
@@ -1,7 +1,6 @@
 """Graph Neural Network backbone."""
 import torch
 import torch.nn as nn
-from einops.layers.torch import Rearrange, Reduce
 
 from ...environment.constants import EAST, N_SIDES, NORTH, SOUTH, WEST
 from ..class_encoding import ClassEncoding
@@ -115,7 +114,6 @@ class GNNBackbone(nn.Module):
 
         self.embed_tokens = nn.Sequential(
             ClassEncoding(embedding_dim),
-            Rearrange("b t h w e -> b h w t e"),
         )
 
         self.exter_layers = nn.ModuleList(
@@ -134,7 +132,6 @@ class GNNBackbone(nn.Module):
                 for _ in range(n_layers)
             ]
         )
-        self.to_sequence = Reduce("b h w t e -> (h w) b e", reduction="mean")
 
     def forward(self, boards: torch.Tensor) -> torch.Tensor:
         """Do the forward pass of the GNN backbone.
@@ -142,15 +139,16 @@ class GNNBackbone(nn.Module):
         ---
         Args:
             boards: The input boards.
-                Shape of [batch_size, board_height, board_width, N_SIDES].
+                Shape of [batch_size, N_SIDES, board_height, board_width].
 
         ---
         Returns:
             tokens: The updated tokens embeddings.
-                Shape of [board_height * board_width, embedding_dim].
+                Shape of [board_height * board_width, batch_size, embedding_dim].
         """
-        # To shape [batch_size, board_height, board_width, N_SIDES, embedding_dim].
-        tokens = self.embed_tokens(boards)
+        # The classes are moved to the last dimension before being embedded,
+        # to shape [batch_size, board_height, board_width, N_SIDES, embedding_dim].
+        tokens = self.embed_tokens(boards.permute(0, 2, 3, 1))
 
         for inter, exter, mlp in zip(
             self.inter_layers, self.exter_layers, self.mlp_layers
@@ -160,4 +158,6 @@ class GNNBackbone(nn.Module):
             tokens = inter(tokens, shift=-1) + tokens
             tokens = mlp(tokens) + tokens
 
-        return self.to_sequence(tokens)
+        # To shape [board_height * board_width, batch_size, embedding_dim].
+        tokens = tokens.mean(dim=3)
+        return tokens.flatten(start_dim=1, end_dim=2).transpose(0, 1)
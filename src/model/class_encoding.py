@@ -48,9 +48,14 @@ class ClassEncoding(nn.Module):
             The board with encoded classes.
                 Shape of [..., embedding_dim].
         """
-        assert (
-            board.max().item() < self.embedding_dim
-        ), f"Not enough orthogonal vectors {board.max().item()} vs {self.embedding_dim}."
+        # Avoid a graph break when compiling, and a host sync when capturing
+        # a CUDA graph.
+        if not torch.compiler.is_compiling() and not (
+            torch.cuda.is_available() and torch.cuda.is_current_stream_capturing()
+        ):
+            assert (
+                board.max().item() < self.embedding_dim
+            ), f"Not enough orthogonal vectors {board.max().item()} vs {self.embedding_dim}."
 
         # Encode the classes of each tile.
         return self.class_enc(board)
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-from einops import repeat
 from torchinfo import summary
 
 from ..environment import N_SIDES
@@ -62,6 +61,6 @@ class Critic(nn.Module):
         """
         batch_size = tiles.shape[0]
         tiles = self.backbone(tiles)
-        queries = repeat(self.value_query, "e -> b e", b=batch_size)
+        queries = self.value_query.unsqueeze(0).expand(batch_size, -1)  # No copy.
         values = self.estimate_value(tiles, queries)
-        return values
+        return values.float()  # In case of autocast.
@@ -0,0 +1,68 @@
+"""Replay the forward of a module with CUDA graphs.
+
+Source: https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs.
+"""
+import torch
+import torch.nn as nn
+
+
+class CUDAGraphModule:
+    """Capture the forward of a module into a CUDA graph and replay it.
+    This removes the launch overhead of the many small kernels of the forward.
+
+    The graph is captured for the given example inputs and keyword arguments.
+    Later calls must use inputs of the same shapes and the same keyword arguments.
+    The graph reads the parameters in-place, so the optimizer updates are seen
+    by the next replays.
+
+    ---
+    Parameters:
+        module: The module to capture, already on a CUDA device.
+        inputs: Example inputs of the forward.
+        warmup_steps: Number of eager forwards before the capture.
+        kwargs: The keyword arguments of the forward, fixed for all replays.
+    """
+
+    def __init__(
+        self,
+        module: nn.Module,
+        *inputs: torch.Tensor,
+        warmup_steps: int = 3,
+        **kwargs,
+    ):
+        self.module = module
+        self.kwargs = kwargs
+        self.static_inputs = [x.clone() for x in inputs]
+
+        # Warm up on a side stream, so that the lazy initializations
+        # are not captured.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup_steps):
+                module(*self.static_inputs, **kwargs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_outputs = module(*self.static_inputs, **kwargs)
+
+    def __call__(
+        self, *inputs: torch.Tensor, **kwargs
+    ) -> torch.Tensor | tuple[torch.Tensor, ...]:
+        """Copy the inputs into the static inputs and replay the graph.
+
+        ---
+        Returns:
+            A copy of the outputs, since the static outputs are overwritten
+            by the next replay.
+        """
+        assert kwargs == self.kwargs, "The graph was captured with other arguments."
+
+        for static_input, x in zip(self.static_inputs, inputs):
+            static_input.copy_(x)
+        self.graph.replay()
+
+        if isinstance(self.static_outputs, torch.Tensor):
+            return self.static_outputs.clone()
+        return tuple(output.clone() for output in self.static_outputs)
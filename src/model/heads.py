@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn as nn
 
@@ -45,20 +47,21 @@ class SelectTile(nn.Module):
 
         ---
         Returns:
-            A probability distribution over the tiles.
+            The logits of the distribution over the tiles.
                 Tensor of shape [batch_size, n_tiles].
         """
         query = query.unsqueeze(0)
         query = self.decoder(query, tiles)
         query = self.norm(query)
-        _, node_distributions = self.attention_layer(
-            query,
-            tiles,
-            tiles,
-            need_weights=True,
-            average_attn_weights=True,
-        )
-        return node_distributions.squeeze(1)
+
+        # The attention scores are computed without their softmax,
+        # which is left to the sampling.
+        embedding_dim = query.shape[-1]
+        w_query, w_key, _ = self.attention_layer.in_proj_weight.chunk(3)
+        query = nn.functional.linear(query.squeeze(0), w_query)
+        keys = nn.functional.linear(tiles, w_key)
+        logits = torch.einsum("be,tbe->bt", query, keys)
+        return logits / math.sqrt(embedding_dim)
 
 
 class SelectSide(nn.Module):
@@ -79,28 +82,26 @@ class SelectSide(nn.Module):
         self.predict_side = nn.Sequential(
             nn.LayerNorm(embedding_dim),
             nn.Linear(embedding_dim, N_SIDES),
-            nn.Softmax(dim=-1),
         )
 
-    def forward(self, tiles: torch.Tensor, query: torch.Tensor) -> torch.Tensor:
-        """Select a side by using a cross-attention operation between
-        the tiles and some query.
+    def forward(self, tiles: torch.Tensor, queries: torch.Tensor) -> torch.Tensor:
+        """Select multiple sides at once by using a cross-attention operation
+        between the tiles and the queries.
 
         ---
         Args:
             tiles: The tiles, already embedded.
                 Tensor of shape [n_tiles, batch_size, embedding_dim].
-            query: The query.
-                Tensor of shape [batch_size, embedding_dim].
+            queries: The queries, one for each side to select.
+                Tensor of shape [n_queries, batch_size, embedding_dim].
 
         ---
         Returns:
-            A probability distribution over the sides.
-                Tensor of shape [batch_size, N_SIDES].
+            The logits of the distributions over the sides.
+                Tensor of shape [batch_size, n_queries, N_SIDES].
         """
-        query = query.unsqueeze(0)
-        query = self.decoder(query, tiles)
-        return self.predict_side(query.squeeze(0))
+        queries = self.decoder(queries, tiles)
+        return self.predict_side(queries.transpose(0, 1))
 
 
 class EstimateValue(nn.Module):
@@ -1,8 +1,7 @@
-import numpy as np
+import math
+
 import torch
 import torch.nn as nn
-from einops import rearrange, repeat
-from torch.distributions import Categorical
 from torchinfo import summary
 
 from ..environment import N_SIDES
@@ -31,7 +30,6 @@ class Policy(nn.Module):
         self.side_query = nn.Parameter(torch.randn(embedding_dim))
 
         self.tiles_embeddings = nn.Parameter(torch.randn(2, embedding_dim))
-        self.sides_embeddings = nn.Parameter(torch.randn(N_SIDES, embedding_dim))
 
     def dummy_input(
         self, board_height: int, board_width: int, device: str
@@ -86,56 +84,64 @@ class Policy(nn.Module):
         batch_size = tiles.shape[0]
 
         tiles = self.backbone(tiles)
-        actions, logprobs, entropies = [], [], []
+        actions = torch.empty((batch_size, 4), dtype=torch.long, device=tiles.device)
+        # The statistics are kept in fp32, even under autocast.
+        logprobs = torch.empty((batch_size, 4), dtype=torch.float, device=tiles.device)
+        entropies = torch.empty_like(logprobs)
+
+        # Broadcasted view, no copy.
+        tile_queries = self.tile_query.unsqueeze(0).expand(batch_size, -1)
+        # Shared by all selective additions.
+        batch_range = torch.arange(batch_size, device=tiles.device)
 
         # Node selections.
         for node_number in range(2):
-            queries = repeat(self.tile_query, "e -> b e", b=batch_size)
-            probs = self.select_tile(tiles, queries)
-
-            if sampled_actions is None:
-                sampled_tiles = self.sample_actions(probs, sampling_mode)
-            else:
-                sampled_tiles = sampled_actions[:, node_number]
-            actions_logprob, actions_entropy = Policy.logprobs(probs, sampled_tiles)
-
-            actions.append(sampled_tiles)
-            logprobs.append(actions_logprob)
-            entropies.append(actions_entropy)
-
-            selected_embedding = self.tiles_embeddings[node_number]
-            selected_embedding = repeat(selected_embedding, "e -> b e", b=batch_size)
-            tiles = Policy.selective_add(tiles, selected_embedding, sampled_tiles)
-
-        # Side selections.
-        for side_number in range(2):
-            queries = repeat(self.side_query, "e -> b e", b=batch_size)
-            probs = self.select_side(tiles, queries)
-
-            if sampled_actions is None:
-                sampled_sides = self.sample_actions(probs, sampling_mode)
-            else:
-                sampled_sides = sampled_actions[:, side_number + 2]
-            actions_logprob, actions_entropy = Policy.logprobs(probs, sampled_sides)
-
-            actions.append(sampled_sides)
-            logprobs.append(actions_logprob)
-            entropies.append(actions_entropy)
-
-            side_embedding = self.sides_embeddings[sampled_sides]
-            tiles = Policy.selective_add(tiles, side_embedding, actions[side_number])
+            logits = self.select_tile(tiles, tile_queries)
+
+            sampled_tiles = (
+                None if sampled_actions is None else sampled_actions[:, node_number]
+            )
+            sampled_tiles, actions_logprob, actions_entropy = Policy.sample_and_stats(
+                logits, sampling_mode, sampled_tiles
+            )
+
+            actions[:, node_number] = sampled_tiles
+            logprobs[:, node_number] = actions_logprob
+            entropies[:, node_number] = actions_entropy
+
+            selected_embedding = self.tiles_embeddings.select(0, node_number)
+            selected_embedding = selected_embedding.unsqueeze(0).expand(batch_size, -1)
+            tiles = Policy.selective_add(
+                tiles, selected_embedding, sampled_tiles, batch_range
+            )
+
+        # Side selections. The sides of both tiles are predicted in a single call,
+        # each query being specialised by the embedding of its selected tile.
+        side_queries = self.side_query.unsqueeze(0) + self.tiles_embeddings
+        side_queries = side_queries.unsqueeze(1).expand(-1, batch_size, -1)
+        logits = self.select_side(tiles, side_queries)
+
+        sampled_sides = (
+            None if sampled_actions is None else sampled_actions[:, 2:].flatten()
+        )
+        sampled_sides, actions_logprob, actions_entropy = Policy.sample_and_stats(
+            logits.flatten(0, 1), sampling_mode, sampled_sides
+        )
 
-        actions = torch.stack(actions, dim=1)
-        logprobs = torch.stack(logprobs, dim=1)
-        entropies = torch.stack(entropies, dim=1)
+        actions[:, 2:] = sampled_sides.view(batch_size, 2)
+        logprobs[:, 2:] = actions_logprob.view(batch_size, 2)
+        entropies[:, 2:] = actions_entropy.view(batch_size, 2)
 
         return actions, logprobs, entropies
 
     @staticmethod
-    def sample_actions(probs: torch.Tensor, mode: str) -> torch.Tensor:
+    def sample_actions(
+        probs: torch.Tensor, log_probs: torch.Tensor, mode: str
+    ) -> torch.Tensor:
         match mode:
             case "softmax":
-                action_ids = Categorical(probs=probs).sample()
+                action_ids = torch.multinomial(probs, 1, replacement=True)
+                action_ids = action_ids.squeeze(1)
             case "greedy":
                 action_ids = torch.argmax(probs, dim=-1)
             case "epsilon":
@@ -143,46 +149,58 @@ class Policy(nn.Module):
             case "epsilon-greedy":
                 action_ids = epsilon_greedy_sampling(probs, epsilon=0.05)
             case "tempered":
-                logits = Categorical(probs=probs).logits
-                logits = logits / 2.0
-                action_ids = Categorical(logits=logits).sample()
+                tempered_probs = torch.softmax(log_probs / 2.0, dim=-1)
+                action_ids = torch.multinomial(tempered_probs, 1, replacement=True)
+                action_ids = action_ids.squeeze(1)
             case _:
                 raise ValueError(f"Invalid mode: {mode}")
         return action_ids
 
     @staticmethod
-    def logprobs(
-        probs: torch.Tensor,
-        action_ids: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        """Sample actions from the given probabilities.
-        Returns the sampled actions and their log-probilities.
+    def sample_and_stats(
+        logits: torch.Tensor,
+        mode: str | None,
+        action_ids: torch.Tensor | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Sample actions from the given logits if no actions are given.
+        Returns the actions, their log-probabilities and the entropies.
+        The log-probabilities are computed only once for all of them.
 
         ---
         Args:
-            probs: Probabilities of the actions.
+            logits: Unnormalized log-probabilities of the actions.
                 Shape of [batch_size, n_actions].
-            action_ids: The actions take.
+            mode: The sampling mode, used if no actions are given.
+            action_ids: The actions taken, if any.
                 Shape of [batch_size,].
 
         ---
         Returns:
-            log_probs: The log-probabilities of the sampled actions.
+            action_ids: The sampled or given actions.
+                Shape of [batch_size,].
+            log_probs: The log-probabilities of the actions.
                 Shape of [batch_size,].
             entropies: The entropy of the categorical distributions.
                 The entropies are normalized by the log of the number of actions.
                 Shape of [batch_size,].
         """
-        categorical = Categorical(probs=probs)
-        n_actions = probs.shape[-1]
+        n_actions = logits.shape[-1]
+        log_probs = nn.functional.log_softmax(logits, dim=-1)
+        probs = log_probs.exp()
+
+        if action_ids is None:
+            action_ids = Policy.sample_actions(probs, log_probs, mode)
 
-        entropies = categorical.entropy() / np.log(n_actions)
-        log_probs = categorical.log_prob(action_ids)
-        return log_probs, entropies
+        entropies = -(probs * log_probs).sum(dim=-1) / math.log(n_actions)
+        log_probs = torch.gather(log_probs, dim=1, index=action_ids.unsqueeze(1))
+        return action_ids, log_probs.squeeze(1), entropies
 
     @staticmethod
     def selective_add(
-        tiles: torch.Tensor, embeddings: torch.Tensor, tile_ids: torch.Tensor
+        tiles: torch.Tensor,
+        embeddings: torch.Tensor,
+        tile_ids: torch.Tensor,
+        batch_range: torch.Tensor | None = None,
     ) -> torch.Tensor:
         """Add the given embeddings only to the specified tiles.
 
@@ -194,18 +212,20 @@ class Policy(nn.Module):
                 Shape of [batch_size, embedding_dim].
             tile_ids: The tile ids to add the embeddings to.
                 Shape of [batch_size,].
+            batch_range: The range of the batch, if already computed.
+                Shape of [batch_size,].
 
         ---
         Returns:
             The new tile embeddings.
                 Shape of [n_tiles, batch_size, embedding_dim].
         """
-        n_tiles, batch_size, _ = tiles.shape
-        device = tiles.device
+        n_tiles, batch_size, embedding_dim = tiles.shape
+        if batch_range is None:
+            batch_range = torch.arange(batch_size, device=tiles.device)
 
-        offsets = torch.arange(0, batch_size * n_tiles, n_tiles, device=device)
-        tiles = rearrange(tiles, "t b e -> (b t) e")
-        tiles[tile_ids + offsets] = tiles[tile_ids + offsets] + embeddings
-        tiles = rearrange(tiles, "(b t) e -> t b e", b=batch_size)
+        # Index the tiles in their "(t b) e" flattened layout.
+        tiles = tiles.reshape(n_tiles * batch_size, embedding_dim)
+        tiles = tiles.index_add(0, tile_ids * batch_size + batch_range, embeddings)
 
-        return tiles
+        return tiles.view(n_tiles, batch_size, embedding_dim)
@@ -3,6 +3,9 @@ import torch
 
 from ..environment import N_SIDES
 from .class_encoding import ClassEncoding
+from .critic import Critic
+from .cuda_graph import CUDAGraphModule
+from .policy import Policy
 
 
 @pytest.mark.parametrize(
@@ -38,3 +41,64 @@ def test_class_encoding(embedding_dim: int, batch_size: int, board_size: int):
     assert torch.allclose(
         ortho @ ortho.T, torch.eye(embedding_dim), atol=1e-4
     ), "Encodings are not orthogonal!"
+
+
+@pytest.mark.parametrize(
+    "n_tiles, batch_size, embedding_dim",
+    [
+        (4, 1, 10),
+        (16, 32, 8),
+        (49, 64, 16),
+    ],
+)
+def test_selective_add(n_tiles: int, batch_size: int, embedding_dim: int):
+    tiles = torch.randn((n_tiles, batch_size, embedding_dim))
+    embeddings = torch.randn((batch_size, embedding_dim))
+    tile_ids = torch.randint(low=0, high=n_tiles, size=(batch_size,))
+
+    added_tiles = Policy.selective_add(tiles, embeddings, tile_ids)
+
+    reference = tiles.clone()
+    for batch_id, tile_id in enumerate(tile_ids):
+        reference[tile_id, batch_id] += embeddings[batch_id]
+
+    assert torch.allclose(added_tiles, reference), "Wrong embeddings added!"
+    assert not torch.allclose(tiles, reference), "The input tiles were modified!"
+
+    batch_range = torch.arange(batch_size)
+    added_tiles = Policy.selective_add(tiles, embeddings, tile_ids, batch_range)
+    assert torch.allclose(added_tiles, reference), "Wrong embeddings added!"
+
+
+def test_capture_safe_forward(monkeypatch: pytest.MonkeyPatch):
+    """Run the forwards as if a CUDA graph was being captured.
+    A host sync (`.item()`) is forbidden during the capture.
+    """
+
+    def forbidden_sync(*args, **kwargs):
+        raise RuntimeError("Host sync during a CUDA graph capture!")
+
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    monkeypatch.setattr(torch.cuda, "is_current_stream_capturing", lambda: True)
+    monkeypatch.setattr(torch.Tensor, "item", forbidden_sync)
+
+    tiles = torch.randint(low=0, high=10, size=(8, N_SIDES, 4, 4))
+    Critic(32, 2, 1, 1, 0.0)(tiles)
+    Policy(32, 2, 1, 1, 0.0)(tiles, sampling_mode="softmax")
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Requires a GPU.")
+def test_cuda_graph_module():
+    critic = Critic(32, 2, 1, 1, 0.0).to("cuda")
+    tiles = torch.randint(low=0, high=10, size=(8, N_SIDES, 4, 4), device="cuda")
+    graphed_critic = CUDAGraphModule(critic, tiles)
+
+    for _ in range(3):
+        tiles = torch.randint(low=0, high=10, size=(8, N_SIDES, 4, 4), device="cuda")
+        assert torch.allclose(graphed_critic(tiles), critic(tiles))
+
+    # The parameters are read in-place by the graph.
+    with torch.no_grad():
+        for param in critic.parameters():
+            param.add_(0.1)
+    assert torch.allclose(graphed_critic(tiles), critic(tiles))
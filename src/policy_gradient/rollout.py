@@ -1,6 +1,4 @@
 """Play some steps."""
-from collections import defaultdict
-
 import einops
 import torch
 from tensordict import TensorDict, TensorDictBase
@@ -10,6 +8,9 @@ from ..environment import EternityEnv
 from ..mcts import MCTSTree
 from ..model import Critic, Policy
 
+# The steps are short, the bars are refreshed at most once per second.
+PROGRESS_MININTERVAL = 1.0
+
 
 def rollout(
     env: EternityEnv,
@@ -34,10 +35,14 @@ def rollout(
     Returns:
         traces: The traces of the played steps.
     """
-    traces = defaultdict(list)
+    traces = dict()
 
     for step_id in tqdm(
-        range(steps), desc="Rollout", leave=False, disable=disable_logs
+        range(steps),
+        desc="Rollout",
+        leave=False,
+        disable=disable_logs,
+        mininterval=PROGRESS_MININTERVAL,
     ):
         sample = dict()
         sample["states"] = env.render()
@@ -45,30 +50,39 @@ def rollout(
         sample["actions"], sample["log-probs"], _ = policy(
             sample["states"], sampling_mode=sampling_mode
         )
+
+        # The step only waits for the actions, it overlaps with the critic forward.
+        # The critic is queued first, since the step syncs with the host.
+        actions_ready = env.record_event()
         sample["values"] = critic(sample["states"])
 
         _, sample["rewards"], sample["dones"], sample["truncated"], _ = env.step(
-            sample["actions"]
+            sample["actions"], actions_ready
         )
 
         sample["next-values"] = critic(env.render())
 
-        sample["next-values"] *= (~sample["dones"]).float()
+        sample["next-values"].masked_fill_(sample["dones"], 0)
 
         if (sample["dones"] | sample["truncated"]).sum() > 0:
             reset_ids = torch.arange(0, env.batch_size, device=env.device)
             reset_ids = reset_ids[sample["dones"] | sample["truncated"]]
             env.reset(reset_ids)
 
-        # BUG: There's an issue with cuda that hallucinates values when stacking
-        # more than 128 tensors. To avoid this issue, we have to offload the tensors
-        # so that we can stack on CPU.
+        # The traces are written in place into buffers allocated at the first step,
+        # instead of being stacked at the end. This also avoids a cuda issue that
+        # hallucinates values when stacking more than 128 tensors.
         for name, tensor in sample.items():
-            traces[name].append(tensor.cpu())
+            if step_id == 0:
+                traces[name] = torch.empty(
+                    (tensor.shape[0], steps, *tensor.shape[1:]),
+                    dtype=tensor.dtype,
+                    device=tensor.device,
+                )
+            traces[name][:, step_id] = tensor
 
-    for name, tensors in traces.items():
-        traces[name] = torch.stack(tensors, dim=1)  # Stack on CPU.
-        traces[name] = traces[name].to(env.device)  # Back to GPU.
+    # The env gives the number of matches gained, normalize them only once here.
+    traces["rewards"] = traces["rewards"] / env.best_possible_matches
 
     return TensorDict(traces, batch_size=traces["states"].shape[0], device=env.device)
 
@@ -92,7 +106,11 @@ def exploit_rollout(
         sampling_mode: The sampling mode to use for the policy.
     """
     for step_id in tqdm(
-        range(steps), desc="Exploit rollout", leave=False, disable=disable_logs
+        range(steps),
+        desc="Exploit rollout",
+        leave=False,
+        disable=disable_logs,
+        mininterval=PROGRESS_MININTERVAL,
     ):
         actions, *_ = policy(env.render(), sampling_mode=sampling_mode)
 
@@ -128,10 +146,14 @@ def mcts_rollout(
     Returns:
         The traces of the played steps.
     """
-    traces = defaultdict(list)
+    traces = dict()
 
     for step_id in tqdm(
-        range(steps), desc="MCTS Rollout", leave=False, disable=disable_logs
+        range(steps),
+        desc="MCTS Rollout",
+        leave=False,
+        disable=disable_logs,
+        mininterval=PROGRESS_MININTERVAL,
     ):
         sample = dict()
         mcts.reset(env, policy, critic)
@@ -154,22 +176,27 @@ def mcts_rollout(
             env.n_steps,
         )
 
-        sample["next-values"] *= (~sample["dones"]).float()
+        sample["next-values"].masked_fill_(sample["dones"], 0)
 
         if (sample["dones"] | sample["truncated"]).sum() > 0:
             reset_ids = torch.arange(0, env.batch_size, device=env.device)
             reset_ids = reset_ids[sample["dones"] | sample["truncated"]]
             env.reset(reset_ids)
 
-        # BUG: There's an issue with cuda that hallucinates values when stacking
-        # more than 128 tensors. To avoid this issue, we have to offload the tensors
-        # so that we can stack on CPU.
+        # The traces are written in place into buffers allocated at the first step,
+        # instead of being stacked at the end. This also avoids a cuda issue that
+        # hallucinates values when stacking more than 128 tensors.
         for name, tensor in sample.items():
-            traces[name].append(tensor.cpu())
-
-    for name, tensors in traces.items():
-        traces[name] = torch.stack(tensors, dim=1)  # Stack on CPU.
-        traces[name] = traces[name].to(env.device)  # Back to GPU.
+            if step_id == 0:
+                traces[name] = torch.empty(
+                    (tensor.shape[0], steps, *tensor.shape[1:]),
+                    dtype=tensor.dtype,
+                    device=tensor.device,
+                )
+            traces[name][:, step_id] = tensor
+
+    # The env gives the number of matches gained, normalize them only once here.
+    traces["rewards"] = traces["rewards"] / env.best_possible_matches
 
     return TensorDict(traces, batch_size=traces["states"].shape[0], device=env.device)
 
@@ -1,23 +1,31 @@
-from itertools import chain, count
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import count
 from pathlib import Path
 from typing import Any
 
-import einops
 import torch
 import torch.optim as optim
 from tensordict import TensorDict
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.nn.utils import clip_grad
 from torch.optim.lr_scheduler import LRScheduler
+from torch.utils._pytree import tree_map_only
 from torchrl.data import ReplayBuffer
 from tqdm import tqdm
 
 import wandb
 
 from ..environment import EternityEnv
-from ..model import Critic, Policy
+from ..model import Critic, CUDAGraphModule, Policy
 from .loss import PPOLoss
-from .rollout import exploit_rollout, rollout, split_reset_rollouts
+from .rollout import (
+    PROGRESS_MININTERVAL,
+    exploit_rollout,
+    rollout,
+    split_reset_rollouts,
+)
 
 
 class Trainer:
@@ -37,6 +45,8 @@ class Trainer:
         epochs: int,
         rollouts: int,
         reset_proportion: float,
+        accumulation_steps: int = 1,
+        compile: bool = False,
     ):
         self.env = env
         self.policy = policy
@@ -52,6 +62,8 @@ class Trainer:
         self.epochs = epochs
         self.rollouts = rollouts
         self.reset_proportion = reset_proportion
+        self.accumulation_steps = accumulation_steps
+        self.compile = compile
 
         self.policy_module = (
             self.policy.module if isinstance(self.policy, DDP) else self.policy
@@ -60,11 +72,39 @@ class Trainer:
             self.critic.module if isinstance(self.critic, DDP) else self.critic
         )
 
-        self.device = env.device
+        # Listed once, to clip their gradients at each update.
+        self.policy_params = list(self.policy.parameters())
+        self.critic_params = list(self.critic.parameters())
+
+        # The device index is made explicit, so that the device compares equal to
+        # the devices of the tensors ("cuda" never equals "cuda:0").
+        self.device = torch.device(env.device)
+        if self.device.type == "cuda" and self.device.index is None:
+            self.device = torch.device("cuda", torch.cuda.current_device())
         self.rng = self.env.rng
 
+        # The forwards run in bf16 on GPU, the gradients are still in fp32.
+        # The bf16 copies of the weights are not cached, as the captured graphs
+        # would read stale copies after the optimizer steps.
+        self.autocast = partial(
+            torch.autocast,
+            device_type=self.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.device.type == "cuda",
+            cache_enabled=False,
+        )
+
+        # Forwards used by the rollouts, captured at the first rollout.
+        self.rollout_policy = None
+        self.rollout_critic = None
+
         # Dynamic infos.
         self.best_matches_found = 0
+        self.last_grads = None  # Mean absolute gradients of the last update.
+
+        # The checkpoints are written to disk in the background.
+        self.checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint_saving: Future | None = None
 
     @torch.inference_mode()
     def do_rollouts(self, disable_logs: bool):
@@ -76,20 +116,25 @@ class Trainer:
         reset_ids = reset_ids[:total_resets]
         self.env.reset(reset_ids)
 
-        # A first rollout in greedy-mode, to exploit the model.
-        self.policy_module.eval()
-        exploit_rollout(self.env, self.policy_module, self.rollouts, disable_logs)
-
-        # Then we collect the rollouts with the current policy.
-        self.policy_module.train()
-        self.critic_module.train()
-        traces = rollout(
-            self.env,
-            self.policy_module,
-            self.critic_module,
-            self.rollouts,
-            disable_logs,
-        )
+        with self.autocast():
+            # A first rollout in greedy-mode, to exploit the model.
+            self.policy_module.eval()
+            exploit_rollout(self.env, self.policy_module, self.rollouts, disable_logs)
+
+            # Then we collect the rollouts with the current policy.
+            # The graphs are captured under autocast, as they are replayed.
+            self.policy_module.train()
+            self.critic_module.train()
+            if self.rollout_policy is None:
+                self.build_rollout_graphs()
+
+            traces = rollout(
+                self.env,
+                self.rollout_policy,
+                self.rollout_critic,
+                self.rollouts,
+                disable_logs,
+            )
 
         traces = split_reset_rollouts(traces)
         self.loss.advantages(traces)
@@ -104,43 +149,105 @@ class Trainer:
         ), "Some samples are missing."
 
         # Flatten the batch x steps dimensions and remove the masked steps.
+        # The kept indices are the same for all traces, they are computed once.
         samples = dict()
-        masks = einops.rearrange(traces["masks"], "b d -> (b d)")
+        sample_ids = traces["masks"].flatten().nonzero().squeeze(1)
         for name, tensor in traces.items():
             if name == "masks":
                 continue
 
-            tensor = einops.rearrange(tensor, "b d ... -> (b d) ...")
-            samples[name] = tensor[masks]
+            samples[name] = tensor.flatten(0, 1).index_select(0, sample_ids)
 
         samples = TensorDict(
             samples, batch_size=samples["states"].shape[0], device=self.device
         )
         self.replay_buffer.extend(samples)
 
+    def build_rollout_graphs(self):
+        """Capture the forwards of the rollouts into CUDA graphs.
+        The rollouts call the models on the same shapes thousands of times,
+        so their launch overhead is removed by replaying the graphs.
+
+        The models are used directly when not on GPU.
+        """
+        if self.device.type != "cuda":
+            self.rollout_policy = self.policy_module
+            self.rollout_critic = self.critic_module
+            return
+
+        states = self.env.render()
+        self.rollout_policy = CUDAGraphModule(
+            self.policy_module, states, sampling_mode="softmax"
+        )
+        self.rollout_critic = CUDAGraphModule(self.critic_module, states)
+
+    def to_device(self, batch: TensorDict) -> TensorDict:
+        """Move the batch to the training device, only if it is not already there.
+        The replay buffer usually stores its samples on this device.
+        """
+        if batch.device == self.device:
+            return batch
+
+        return batch.to(self.device, non_blocking=True)
+
     def do_batch_update(
-        self, batch: TensorDict, train_policy: bool, train_critic: bool
+        self,
+        batch: TensorDict,
+        train_policy: bool,
+        train_critic: bool,
+        is_sync_step: bool = True,
+        window_size: int = 1,
+        record_grads: bool = False,
     ):
-        """Performs a batch update on the model."""
+        """Performs a batch update on the model.
+        The gradients are accumulated until the sync step, where the models
+        are updated. The losses are averaged over the `window_size` batches
+        accumulated for this update. The gradients statistics are only recorded
+        when asked, for the next evaluation.
+        """
         if train_policy:
             self.policy.train()
-            self.policy_optimizer.zero_grad()
 
         if train_critic:
             self.critic.train()
-            self.critic_optimizer.zero_grad()
 
-        batch = batch.to(self.device)
-        metrics = self.loss(batch, self.policy, self.critic)
-        metrics["loss/total"].backward()
+        batch = self.to_device(batch)
+        with ExitStack() as stack:
+            if not is_sync_step:
+                # Skip the all-reduce of the gradients, they are reduced once
+                # accumulated. Both the forward and the backward must be in there.
+                for model in [self.policy, self.critic]:
+                    if isinstance(model, DDP):
+                        stack.enter_context(model.no_sync())
+
+            with self.autocast():
+                metrics = self.loss(batch, self.policy, self.critic)
+            (metrics["loss/total"] / window_size).backward()
+
+        if not is_sync_step:
+            return
+
+        if record_grads:
+            # Keep the gradients statistics for the evaluation, before clipping.
+            # The L1 norms are computed with a single multi-tensor kernel.
+            grads = [p.grad for p in self.policy_params + self.critic_params]
+            grads = [grad for grad in grads if grad is not None]
+            self.last_grads = torch.stack(
+                torch._foreach_div(
+                    torch._foreach_norm(grads, ord=1),
+                    [grad.numel() for grad in grads],
+                )
+            )
 
         if train_policy:
-            clip_grad.clip_grad_norm_(self.policy.parameters(), self.clip_value)
+            clip_grad.clip_grad_norm_(self.policy_params, self.clip_value, foreach=True)
             self.policy_optimizer.step()
+            self.policy_optimizer.zero_grad()
 
         if train_critic:
-            clip_grad.clip_grad_norm_(self.critic.parameters(), self.clip_value)
+            clip_grad.clip_grad_norm_(self.critic_params, self.clip_value, foreach=True)
             self.critic_optimizer.step()
+            self.critic_optimizer.zero_grad()
 
     def launch_training(
         self,
@@ -176,6 +283,12 @@ class Trainer:
             self.policy.to(self.device)
             self.critic.to(self.device)
 
+            # The shapes are fixed during the whole training, let cuDNN pick its
+            # fastest kernels once. TF32 is precise enough for the fp32 matmuls.
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+
             self.env.reset()
             self.best_matches_found = 0  # Reset.
 
@@ -188,6 +301,14 @@ class Trainer:
                 )
                 print(f"\nLaunching training on device {self.device}.\n")
 
+            if self.compile:
+                # Compiled after the summaries, whose hooks would be traced otherwise.
+                # Compiled in-place, the checkpoints keys are unchanged.
+                # The sampling mode is a constant for dynamo, each mode gets its own
+                # graph.
+                self.policy_module.compile(dynamic=False, fullgraph=True)
+                self.critic_module.compile(dynamic=False, fullgraph=True)
+
             # Log gradients and model parameters.
             run.watch(self.policy)
             run.watch(self.critic)
@@ -198,18 +319,41 @@ class Trainer:
             for i in tqdm(iter, desc="Episode", disable=disable_logs):
                 self.do_rollouts(disable_logs=disable_logs)
 
-                for _ in tqdm(
+                # The buffer is filled once per episode, so is its number of batches.
+                n_batches = len(self.replay_buffer) // self.replay_buffer._batch_size
+                for epoch_id in tqdm(
                     range(self.epochs), desc="Epoch", leave=False, disable=disable_logs
                 ):
-                    for batch in tqdm(
-                        self.replay_buffer,
-                        total=len(self.replay_buffer) // self.replay_buffer._batch_size,
+                    for batch_id, batch in tqdm(
+                        enumerate(self.replay_buffer),
+                        total=n_batches,
                         desc="Batch",
                         leave=False,
                         disable=disable_logs,
+                        mininterval=PROGRESS_MININTERVAL,
                     ):
+                        # The models are updated at the end of each accumulation
+                        # and at the end of the epoch, where the last window can
+                        # be shorter.
+                        window_start = batch_id - batch_id % self.accumulation_steps
+                        window_size = min(
+                            self.accumulation_steps, n_batches - window_start
+                        )
+                        is_sync_step = batch_id + 1 == window_start + window_size
+                        # The gradients are only reported by the evaluation
+                        # following the last update of the episode.
+                        record_grads = (
+                            not disable_logs
+                            and epoch_id + 1 == self.epochs
+                            and batch_id + 1 == n_batches
+                        )
                         self.do_batch_update(
-                            batch, train_policy=True, train_critic=True
+                            batch,
+                            train_policy=True,
+                            train_critic=True,
+                            is_sync_step=is_sync_step,
+                            window_size=window_size,
+                            record_grads=record_grads,
                         )
 
                 self.policy_scheduler.step()
@@ -223,6 +367,9 @@ class Trainer:
                         self.save_checkpoint("checkpoint.pt")
                         self.env.save_sample("sample.gif")
 
+            if self.checkpoint_saving is not None:
+                self.checkpoint_saving.result()  # Wait for the last checkpoint.
+
     def evaluate(self) -> dict[str, Any]:
         """Evaluates the model and returns some computed metrics."""
         metrics = dict()
@@ -242,23 +389,18 @@ class Trainer:
 
         # Compute losses.
         batch = self.replay_buffer.sample()
-        batch = batch.to(self.device)
-        metrics |= self.loss(batch, self.policy, self.critic)
+        batch = self.to_device(batch)
+        with torch.no_grad():
+            metrics |= self.loss(batch, self.policy, self.critic)
         metrics["metrics/value-targets"] = wandb.Histogram(batch["value-targets"].cpu())
         metrics["metrics/n-steps"] = wandb.Histogram(self.env.n_steps.cpu())
 
-        # Compute the gradient mean and maximum values.
-        # Also computes the weight absolute mean and maximum values.
-        self.policy.zero_grad()
-        self.critic.zero_grad()
-
-        metrics["loss/total"].backward()
-        weights, grads = [], []
-        for p in chain(self.policy.parameters(), self.critic.parameters()):
-            weights.append(p.data.abs().mean().item())
-
-            if p.grad is not None:
-                grads.append(p.grad.data.abs().mean().item())
+        # Compute the weight absolute mean and maximum values.
+        # Also reports the gradients of the last update, so that no additional
+        # backward is needed.
+        # The means are reduced on device and transferred at once.
+        params = self.policy_params + self.critic_params
+        weights = torch.stack([p.data.abs().mean() for p in params]).tolist()
 
         metrics["lr/policy"] = self.policy_scheduler.get_last_lr()[0]
         metrics["lr/critic"] = self.critic_scheduler.get_last_lr()[0]
@@ -267,16 +409,21 @@ class Trainer:
         metrics["global-weights/max"] = max(weights)
         metrics["global-weights/hist"] = wandb.Histogram(weights)
 
-        metrics["global-gradients/mean"] = sum(grads) / (len(grads) + 1)
-        metrics["global-gradients/max"] = max(grads)
-        metrics["global-gradients/hist"] = wandb.Histogram(grads)
+        # No gradients are recorded if there was no update since the last evaluation.
+        if self.last_grads is not None:
+            grads = self.last_grads.tolist()
+            self.last_grads = None
 
-        self.policy.zero_grad()
-        self.critic.zero_grad()
+            metrics["global-gradients/mean"] = sum(grads) / (len(grads) + 1)
+            metrics["global-gradients/max"] = max(grads)
+            metrics["global-gradients/hist"] = wandb.Histogram(grads)
 
-        for name, value in metrics.items():
-            if isinstance(value, torch.Tensor):
-                metrics[name] = value.item()
+        # Transfer all the remaining tensors at once.
+        names = [
+            name for name, value in metrics.items() if isinstance(value, torch.Tensor)
+        ]
+        values = torch.stack([metrics[name].float().reshape(()) for name in names])
+        metrics |= dict(zip(names, values.tolist()))
 
         if self.best_matches_found < self.env.best_matches_ever:
             self.best_matches_found = self.env.best_matches_ever
@@ -287,14 +434,25 @@ class Trainer:
         return metrics
 
     def save_checkpoint(self, filepath: Path | str):
-        torch.save(
-            {
-                "policy": self.policy.state_dict(),
-                "critic": self.critic.state_dict(),
-                "policy-optimizer": self.policy_optimizer.state_dict(),
-                "critic-optimizer": self.critic_optimizer.state_dict(),
-                "policy-scheduler": self.policy_scheduler.state_dict(),
-                "critic-scheduler": self.critic_scheduler.state_dict(),
-            },
-            filepath,
+        """Save the states of the models, optimizers and schedulers.
+        The states are copied to CPU right away, and written to disk in
+        the background so that the training is not blocked.
+        """
+        state_dict = {
+            "policy": self.policy.state_dict(),
+            "critic": self.critic.state_dict(),
+            "policy-optimizer": self.policy_optimizer.state_dict(),
+            "critic-optimizer": self.critic_optimizer.state_dict(),
+            "policy-scheduler": self.policy_scheduler.state_dict(),
+            "critic-scheduler": self.critic_scheduler.state_dict(),
+        }
+        # Always copied, so that the next updates do not modify the saved states.
+        state_dict = tree_map_only(
+            torch.Tensor, lambda t: t.detach().to("cpu", copy=True), state_dict
+        )
+
+        if self.checkpoint_saving is not None:
+            self.checkpoint_saving.result()  # Raise the errors of the previous save.
+        self.checkpoint_saving = self.checkpoint_writer.submit(
+            torch.save, state_dict, filepath
         )